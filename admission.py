@@ -0,0 +1,216 @@
+# admission.py
+"""
+採点の受け付け制御。
+1人が提出ボタンを連打しても CPU を使い切らないよう、採点キューに積む前に
+ユーザーごとのトークンバケットと採点待ち・採点中の件数を確かめ、あふれたら待たせずに断る。
+
+gunicorn のワーカーが何個あっても同じ上限になるよう、状態は SQLite に置く
+（admission_bucket と admission_reservation。テーブルは metadata.create_all で作る）。
+確認と更新はそれぞれ1つの条件付き INSERT / UPSERT で行うので、同時に来ても上限を超えない。
+"""
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Hashable, Tuple
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, text
+
+# ユーザーごとに続けて受け付ける提出数と、1秒あたりに回復する数
+SUBMIT_BURST = int(os.environ.get("PDOJO_SUBMIT_BURST", "5"))
+SUBMIT_RATE = float(os.environ.get("PDOJO_SUBMIT_RATE", "0.5"))
+# 採点待ちにできるジョブ数（全ワーカーの合計・1人あたり）
+MAX_QUEUED = int(os.environ.get("PDOJO_JUDGE_MAX_QUEUED", "16"))
+MAX_QUEUED_PER_USER = int(os.environ.get("PDOJO_JUDGE_MAX_QUEUED_PER_USER", "2"))
+# 採点待ちと採点中を合わせたジョブ数の上限（全ワーカーの合計）。採点中のジョブはそれぞれ最大
+# run_code.MAX_SANDBOXES 個のサンドボックスを使うので、gunicorn のワーカーを増やしたときはこれで VM 全体の
+# 同時実行を抑える。既定は1プロセスで持てる数（待ち MAX_QUEUED + 採点スレッド PDOJO_JUDGE_WORKERS）
+MAX_IN_FLIGHT = int(os.environ.get("PDOJO_JUDGE_MAX_IN_FLIGHT",
+                                   str(MAX_QUEUED + int(os.environ.get("PDOJO_JUDGE_WORKERS", "2")))))
+# 予約をこれより長く残さない（キューに積む前に落ちたリクエストの分を数え続けないため）
+RESERVATION_TTL = 15 * 60
+# 終了したワーカーの予約と満タンのバケットを片付ける間隔（秒）
+_CLEANUP_INTERVAL = 10
+
+metadata = MetaData()
+
+buckets = Table(
+    "admission_bucket", metadata,
+    Column("key", String(100), primary_key=True),
+    Column("tokens", Float, nullable=False),
+    Column("updated", Float, nullable=False),  # tokens を計算した時刻（time.time()）
+)
+
+# 受け付けてから採点が終わるまでの1件ごとの予約
+reservations = Table(
+    "admission_reservation", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("key", String(100), nullable=False, index=True),
+    Column("pid", Integer, nullable=False),  # 受け付けたワーカー
+    Column("created", Float, nullable=False),
+    Column("started", Float),  # 採点を始めた時刻。採点待ちの間は NULL
+)
+
+_RESERVE = text("""
+    INSERT INTO admission_reservation (key, pid, created)
+    SELECT :key, :pid, :now
+    WHERE (SELECT COUNT(*) FROM admission_reservation WHERE started IS NULL) < :max_queued
+      AND (SELECT COUNT(*) FROM admission_reservation WHERE key = :key AND started IS NULL) < :max_queued_per_user
+      AND (SELECT COUNT(*) FROM admission_reservation) < :max_in_flight
+    RETURNING id
+""")
+
+# 経過時間の分だけ回復させてから1つ取る。足りなければ何も変えない
+_TAKE_TOKEN = text("""
+    INSERT INTO admission_bucket (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+    ON CONFLICT (key) DO UPDATE SET tokens = MIN(:burst, tokens + (:now - updated) * :rate) - 1, updated = :now
+    WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= 1
+    RETURNING tokens
+""")
+
+class Rejected(Exception):
+    """受け付けなかった。retry_after 秒ほど待ってから出し直してもらう。"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason  # "rate"（出しすぎ）か "busy"（全体が混んでいる）
+        self.retry_after = max(1, math.ceil(retry_after))
+
+def _is_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class AdmissionController:
+    """
+    採点キュー（judge.JudgeQueue）の前に置く受け付け係。
+    admit(key) が通ったら、同じ key で submit してキューに積む。予約は採点が終わった時点で消える。
+    """
+
+    def __init__(self, queue, engine, rate: float = SUBMIT_RATE, burst: int = SUBMIT_BURST,
+                 max_queued: int = MAX_QUEUED, max_queued_per_user: int = MAX_QUEUED_PER_USER,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.queue = queue
+        self.engine = engine
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._rejected = {"rate": 0, "busy": 0}
+        self._cleaned = 0.0
+
+    def _estimated_wait(self, depth) -> float:
+        # 前に並んでいる分がはけるまでのおおよその秒数
+        duration = self.queue.stats()["duration_avg"] or 1.0
+        return depth * duration / max(1, self.queue.workers)
+
+    def _cleanup(self, conn, now):
+        conn.execute(text("DELETE FROM admission_reservation WHERE created < :cutoff"),
+                     {"cutoff": now - RESERVATION_TTL})
+        if now - self._cleaned < _CLEANUP_INTERVAL:
+            return
+        self._cleaned = now
+        pids = [pid for (pid,) in conn.execute(text("SELECT DISTINCT pid FROM admission_reservation"))]
+        for pid in pids:
+            if not _is_alive(pid):
+                conn.execute(text("DELETE FROM admission_reservation WHERE pid = :pid"), {"pid": pid})
+        # 満タンまで回復したバケットは、無いのと同じなので消す
+        conn.execute(text("DELETE FROM admission_bucket WHERE tokens + (:now - updated) * :rate >= :burst"),
+                     {"now": now, "rate": self.rate, "burst": self.burst})
+
+    def admit(self, key: Hashable) -> int:
+        """予約の ID を返す。受け付けられなければ Rejected を送出する（何も記録しない）。"""
+        key = str(key)
+        now = time.time()
+        try:
+            with self.engine.begin() as conn:
+                self._cleanup(conn, now)
+                reservation = conn.execute(_RESERVE, {
+                    "key": key, "pid": os.getpid(), "now": now,
+                    "max_queued": self.max_queued, "max_queued_per_user": self.max_queued_per_user,
+                    "max_in_flight": self.max_in_flight,
+                }).scalar()
+                if reservation is None:
+                    total, queued, mine = conn.execute(text(
+                        "SELECT COUNT(*), COUNT(CASE WHEN started IS NULL THEN 1 END),"
+                        " COUNT(CASE WHEN key = :key AND started IS NULL THEN 1 END) FROM admission_reservation"
+                    ), {"key": key}).one()
+                    if total >= self.max_in_flight:
+                        raise Rejected("busy", self._estimated_wait(total - self.max_in_flight + 1))
+                    if queued >= self.max_queued:
+                        raise Rejected("busy", self._estimated_wait(queued - self.max_queued + 1))
+                    raise Rejected("rate", self._estimated_wait(mine))
+                taken = conn.execute(_TAKE_TOKEN, {"key": key, "now": now, "rate": self.rate,
+                                                   "burst": self.burst}).scalar()
+                if taken is None:
+                    tokens, updated = conn.execute(
+                        text("SELECT tokens, updated FROM admission_bucket WHERE key = :key"), {"key": key}).one()
+                    tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                    # 例外で抜けるので、予約も取り消される
+                    raise Rejected("rate", (1 - tokens) / self.rate if self.rate > 0 else math.inf)
+        except Rejected as e:
+            with self._lock:
+                self._rejected[e.reason] += 1
+            raise
+        with self._lock:
+            self._admitted += 1
+        return reservation
+
+    def release(self, reservation: int):
+        """予約を消す（何度呼んでもよい）。"""
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM admission_reservation WHERE id = :id"), {"id": reservation})
+
+    def _start(self, reservation: int):
+        # 採点待ちから採点中にする（max_in_flight には数えたまま、max_queued の枠を空ける）
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE admission_reservation SET started = :now WHERE id = :id"),
+                         {"id": reservation, "now": time.time()})
+
+    def submit(self, reservation: int, func, *args, key: Hashable) -> Future:
+        """
+        admit で受け付けたジョブをキューに積む。採点が終わるか、始まらずに終わったら予約を消す。
+        """
+
+        def run(*args):
+            self._start(reservation)
+            return func(*args)
+
+        future = self.queue.submit(run, *args, key=key)
+        future.add_done_callback(lambda _: self.release(reservation))
+        return future
+
+    def counts(self) -> Tuple[int, int]:
+        """全ワーカーの (採点待ち, 採点中) のジョブ数。"""
+        with self.engine.connect() as conn:
+            return tuple(conn.execute(text(
+                "SELECT COUNT(CASE WHEN started IS NULL THEN 1 END), COUNT(started) FROM admission_reservation"
+            )).one())
+
+    def queued(self) -> int:
+        """全ワーカーの採点待ちのジョブ数。"""
+        return self.counts()[0]
+
+    def stats(self) -> dict:
+        """件数はこのワーカーの分、queued と running は全ワーカーの合計。"""
+        queued, running = self.counts()
+        with self._lock:
+            return {
+                "admitted": self._admitted,
+                "rejected_rate": self._rejected["rate"],
+                "rejected_busy": self._rejected["busy"],
+                "queued": queued,
+                "running": running,
+                "max_queued": self.max_queued,
+                "max_queued_per_user": self.max_queued_per_user,
+                "max_in_flight": self.max_in_flight,
+                "queue": self.queue.stats(),
+            }
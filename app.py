@@ -1,13 +1,39 @@
 # app.py
-from flask import Flask, request, render_template, redirect, url_for, flash, abort, jsonify
+from flask import Flask, request, render_template, redirect, url_for, flash, abort, jsonify, Response, stream_with_context, make_response, g, has_request_context
+from flask.signals import before_render_template, template_rendered
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from run_code import extract_relevant_error, check_syntax, run_code, check_forbidden_operations
-from gpt_hint import get_ai_hint, get_wrong_answer, get_forbidden_hint
+from gpt_hint import (
+    get_ai_hint, get_wrong_answer, get_forbidden_hint,
+    stream_ai_hint, stream_wrong_answer, stream_forbidden_hint,
+    HintAborted, HintBusy, hint_stats,
+)
+from judge import judge_submission, JudgeQueue
+from admission import AdmissionController, Rejected, metadata as admission_tables
+from run_code import TIME_LIMIT_EXCEEDED, MEMORY_LIMIT_EXCEEDED, MAX_SANDBOXES, check_forbidden_operations, sandboxes_in_flight
+from caches import LRUCache, SingleFlight, code_hash
+from migrations import upgrade as upgrade_schema
+import testdata
+import textblobs
+import packs
+import metrics
+import click
 import os
-from datetime import datetime, timezone
-from sqlalchemy import distinct
+import re
+import fcntl
+import json
+import time
+import threading
+import uuid
+import hashlib
+import base64
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, tuple_, case, func, insert, update, text, or_, and_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import load_only, selectinload, Session as OrmSession
+from sqlalchemy.exc import IntegrityError
 
 app = Flask(__name__)
 
@@ -16,10 +42,102 @@ app.jinja_env.globals.update(enumerate=enumerate)
 app.secret_key = "your_secret_key"  # セッション用の秘密鍵。実際は安全な値にしてください。
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, '/data/pdojo.sqlite3')}"
+app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, testdata.DATA_DIR, 'pdojo.sqlite3')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# /metrics に Bearer トークンを要求する場合に設定する（空なら誰でも見られる）
+app.config['METRICS_TOKEN'] = os.environ.get("PDOJO_METRICS_TOKEN", "")
+# テストデータのアップロードを受け付ける最大サイズ
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("PDOJO_MAX_UPLOAD_MB", "256")) * 1024 * 1024
+# 採点結果キャッシュ（メモリ上の件数と、SQLite にも保存するか）
+app.config['VERDICT_CACHE_SIZE'] = int(os.environ.get("PDOJO_VERDICT_CACHE_SIZE", "2048"))
+app.config['VERDICT_CACHE_PERSIST'] = os.environ.get("PDOJO_VERDICT_CACHE_PERSIST", "1") == "1"
+# SQLite に残す採点結果の有効期限の秒数と最大件数
+app.config['VERDICT_CACHE_TTL'] = int(os.environ.get("PDOJO_VERDICT_CACHE_TTL", str(30 * 24 * 3600)))
+app.config['VERDICT_CACHE_PERSIST_SIZE'] = int(os.environ.get("PDOJO_VERDICT_CACHE_PERSIST_SIZE", "20000"))
+# ヒントキャッシュ（有効期限の秒数と、SQLite に残す最大件数）
+app.config['HINT_CACHE_TTL'] = int(os.environ.get("PDOJO_HINT_CACHE_TTL", str(7 * 24 * 3600)))
+app.config['HINT_CACHE_SIZE'] = int(os.environ.get("PDOJO_HINT_CACHE_SIZE", "5000"))
+# 提出コード・ヒント文の本体をメモリに置いておく件数（内容で引くので書き換わらない）
+app.config['TEXT_CACHE_SIZE'] = int(os.environ.get("PDOJO_TEXT_CACHE_SIZE", "1024"))
+# 未ログイン向けに描画したページを SQLite にも保存して、ワーカー間で共有するか
+app.config['PAGE_CACHE_PERSIST'] = os.environ.get("PDOJO_PAGE_CACHE_PERSIST", "0") == "1"
+# SQLite の接続設定。gunicorn の複数ワーカーと採点スレッドが同じファイルに書き込むので、
+# WAL にして読み込みが書き込みを待たないようにし、ロック中は busy_timeout まで待つ
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get("PDOJO_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get("PDOJO_SQLITE_MMAP_MB", "64")) * 1024 * 1024
+app.config['SQLITE_CACHE_KB'] = int(os.environ.get("PDOJO_SQLITE_CACHE_KB", "16384"))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "connect_args": {
+        "timeout": app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        # 採点ジョブのスレッドでも接続を使う（1つの接続を同時に使うことはない）
+        "check_same_thread": False,
+    },
+    # 1ワーカーあたりリクエスト1本＋採点スレッド分あれば足りる。足りなければ少し待ってから失敗させる
+    "pool_size": int(os.environ.get("PDOJO_DB_POOL_SIZE", "5")),
+    "max_overflow": 5,
+    "pool_timeout": 10,
+}
 db = SQLAlchemy(app)
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+        cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+        cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_KB']}")
+    finally:
+        cursor.close()
+
+# --- メトリクス ---------------------------------------------------------------
+# リクエスト・コミット・テンプレート描画の時間を metrics に送る（/metrics で見られる）
+
+def _metrics_endpoint():
+    return (request.endpoint or "none") if has_request_context() else "background"
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.observe("pdojo_http_request_seconds", time.perf_counter() - started,
+                        endpoint=_metrics_endpoint(), method=request.method, status=response.status_code)
+    return response
+
+@event.listens_for(OrmSession, "before_commit")
+def _start_commit_timer(session):
+    session.info["commit_started"] = time.perf_counter()
+
+@event.listens_for(OrmSession, "after_commit")
+def _observe_commit(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        metrics.observe("pdojo_db_commit_seconds", time.perf_counter() - started, endpoint=_metrics_endpoint())
+
+@event.listens_for(OrmSession, "after_rollback")
+def _count_rollback(session):
+    session.info.pop("commit_started", None)
+    metrics.inc("pdojo_db_rollbacks_total", endpoint=_metrics_endpoint())
+
+# 描画中のテンプレートの開始時刻（include などで入れ子になるのでスタックにする）
+_render_started = threading.local()
+
+@before_render_template.connect_via(app)
+def _start_render_timer(sender, template, context, **extra):
+    if not hasattr(_render_started, "stack"):
+        _render_started.stack = []
+    _render_started.stack.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _observe_render(sender, template, context, **extra):
+    stack = getattr(_render_started, "stack", None)
+    if stack:
+        metrics.observe("pdojo_template_render_seconds", time.perf_counter() - stack.pop(), template=template.name)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
@@ -55,13 +173,40 @@ class User(UserMixin, db.Model):
         self.last_hint_reset = datetime.now(timezone.utc)
 
 class Submission(db.Model):
+    __table_args__ = (
+        # トップページの「解いた問題」（user_id, status で絞って problem_id を DISTINCT）
+        db.Index('ix_submission_user_status_problem', 'user_id', 'status', 'problem_id'),
+        # 提出履歴（user_id で絞って submission_time 順）
+        db.Index('ix_submission_user_time', 'user_id', 'submission_time', 'id'),
+        # 再採点（problem_id で絞って id 順）
+        db.Index('ix_submission_problem', 'problem_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     problem_id = db.Column(db.Integer, nullable=False)  # 提出された問題のID
     submission_time = db.Column(db.DateTime, default=datetime.now(timezone.utc))
     status = db.Column(db.String(50))  # "Accepted", "Wrong Answer", "Error"など
-    code = db.Column(db.Text)          # ユーザーが提出したコード
-    hint = db.Column(db.Text)          # GPTから得たヒント
+    # コードとヒントの本体は text_blob に置き（同じ内容は1行だけ）、ここには sha256 だけを持つ
+    code_hash = db.Column(db.String(64))  # ユーザーが提出したコード
+    hint_hash = db.Column(db.String(64))  # GPTから得たヒント（無ければ NULL）
+    # 以前の形式（本体を行に持っていた）。マイグレーションで text_blob に移して NULL にする
+    code_inline = db.Column('code', db.Text)
+    hint_inline = db.Column('hint', db.Text)
+    max_wall_time = db.Column(db.Float)     # テストケース中で最大の実行時間（秒）
+    max_cpu_time = db.Column(db.Float)      # テストケース中で最大の CPU 時間（秒）
+    peak_memory_kb = db.Column(db.Integer)  # テストケース中で最大のメモリ使用量（KB）
+
+    @property
+    def code(self) -> str:
+        if self.code_hash is None:
+            return self.code_inline or ""
+        return load_text(self.code_hash)
+
+    @property
+    def hint(self) -> str:
+        if self.hint_hash is None:
+            return self.hint_inline or ""
+        return load_text(self.hint_hash)
 
 class Problem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -75,14 +220,167 @@ class Problem(db.Model):
     
 class TestCase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    problem_id = db.Column(db.Integer, db.ForeignKey('problem.id'), nullable=False)
+    problem_id = db.Column(db.Integer, db.ForeignKey('problem.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # 問題の中での並び順
+    is_sample = db.Column(db.Boolean, nullable=False, default=False)  # 問題ページにサンプルとして出すか
+    # テストデータの本体は testdata のファイルに置き、ここには sha256 とバイト数だけを持つ
+    input_hash = db.Column(db.String(64))
+    input_size = db.Column(db.Integer)
+    output_hash = db.Column(db.String(64))
+    output_size = db.Column(db.Integer)
+    # 以前の形式（本体を DB に持っていた）。マイグレーションでファイルに移して NULL にする
     input_data = db.Column(db.Text, nullable=True)
     expected_output = db.Column(db.Text, nullable=True)
 
-    problem = db.relationship('Problem', backref=db.backref('test_cases', lazy=True))
+    problem = db.relationship('Problem', backref=db.backref(
+        'test_cases', lazy=True, order_by=lambda: (TestCase.position, TestCase.id)))
+
+    def input_source(self):
+        """採点に渡す入力。ファイルに置いたものはそのパス、古い形式のものは文字列。"""
+        return testdata.blob_path(self.input_hash) if self.input_hash else (self.input_data or "")
+
+    def expected_source(self):
+        """採点に渡す期待する出力。input_source と同じ形。"""
+        return testdata.blob_path(self.output_hash) if self.output_hash else (self.expected_output or "")
+
+    def input_preview(self, limit):
+        if self.input_hash:
+            return testdata.read_preview(self.input_hash, limit)
+        return _cut(self.input_data or "", limit)
+
+    def expected_preview(self, limit):
+        if self.output_hash:
+            return testdata.read_preview(self.output_hash, limit)
+        return _cut(self.expected_output or "", limit)
+
+def _cut(text, limit):
+    return text[:limit] + "…" if len(text) > limit else text
+
+def new_test_case(problem_id, position, input_ref, output_ref, is_sample=False):
+    """testdata に保存済みの (sha256, バイト数) からテストケースを作る。"""
+    return TestCase(
+        problem_id=problem_id,
+        position=position,
+        is_sample=is_sample,
+        input_hash=input_ref[0],
+        input_size=input_ref[1],
+        output_hash=output_ref[0],
+        output_size=output_ref[1],
+    )
+
+class UserProblemStatus(db.Model):
+    # ユーザーごと・問題ごとの成績。提出の判定が出るたびに更新し、一覧ページはここだけを見る
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    problem_id = db.Column(db.Integer, primary_key=True)
+    best_status = db.Column(db.String(50), nullable=False)  # 一度でも Accepted なら "Accepted"、それ以外は最後の判定
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # 判定の出た提出の数
+    first_accepted_at = db.Column(db.DateTime)  # 初めて Accepted になった日時
+    last_submitted_at = db.Column(db.DateTime)
+
+class JudgeJob(db.Model):
+    # 非同期採点ジョブ。どの gunicorn ワーカーからでも進捗を返せるよう DB に置く
+    id = db.Column(db.String(32), primary_key=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submission.id'), nullable=True)
+    problem_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued")  # "queued", "running", "done", "error"
+    total = db.Column(db.Integer, nullable=False, default=0)  # テストケース数
+    results = db.Column(db.Text, nullable=False, default="{}")  # {テストケース番号: 判定結果} の JSON
+    overall = db.Column(db.String(50))
+    hint_prompt = db.Column(db.Text)
+    hint_params = db.Column(db.Text)  # JSON
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+class RejudgeJob(db.Model):
+    # 問題の提出をまとめて採点し直すジョブ。進捗と取り消しは DB を通してどのワーカーからでも扱える
+    id = db.Column(db.String(32), primary_key=True)
+    problem_id = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default="queued")  # "queued", "running", "done", "cancelled", "error"
+    statuses = db.Column(db.Text)  # 対象を絞る元の判定（JSON のリスト）。NULL なら全部
+    user_id = db.Column(db.Integer)  # 対象を絞るユーザー。NULL なら全員
+    max_submission_id = db.Column(db.Integer)  # ジョブ作成時点の最新の提出。これより後の提出は新しいテストで採点済み
+    total = db.Column(db.Integer, nullable=False, default=0)  # 対象の提出数
+    done = db.Column(db.Integer, nullable=False, default=0)  # 採点し直して反映した提出数
+    unique_codes = db.Column(db.Integer, nullable=False, default=0)  # 実際に実行するコード数（同じコードは1回）
+    changed = db.Column(db.Integer, nullable=False, default=0)  # 判定が変わった提出数
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "problem_id": self.problem_id,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "unique_codes": self.unique_codes,
+            "changed": self.changed,
+            "cancel_requested": self.cancel_requested,
+            "error": self.error,
+        }
+
+class VersionStamp(db.Model):
+    # キャッシュ無効化用のバージョン番号。name は "testset:<problem_id>" など
+    name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)  # 最後に進めた日時（Last-Modified に使う）
+
+class PageCacheEntry(db.Model):
+    # 描画済みページのキャッシュをワーカー間で共有するための層（PDOJO_PAGE_CACHE_PERSIST=1 のときだけ使う）
+    key = db.Column(db.String(200), primary_key=True)  # "<ページ名>:<カタログのバージョン>"
+    name = db.Column(db.String(150), nullable=False, index=True)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class VerdictCacheEntry(db.Model):
+    # 採点結果キャッシュの永続化層。gunicorn の各ワーカーで共有し、再起動後も使う
+    key = db.Column(db.String(64), primary_key=True)
+    problem_id = db.Column(db.Integer, nullable=False, index=True)
+    verdict = db.Column(db.Text, nullable=False)  # judge_submission の戻り値（JSON）
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    last_used_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+class HintCacheEntry(db.Model):
+    # 同じ問題・同じコード・同じエラーに対する GPT のヒントを使い回すためのキャッシュ
+    key = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # "forbidden", "wrong_answer", "general"
+    problem_id = db.Column(db.Integer, nullable=False, index=True)
+    hint = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    last_used_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+class HintLedger(db.Model):
+    # ヒント回数の増減の記録。消費は -1、失敗して返したものは +1
+    __table_args__ = (
+        # 同じヒント要求の消費を二重に数えない（consume_hint_credit の request_id）
+        db.Index('ix_hint_ledger_request', 'user_id', 'request_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    delta = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(20), nullable=False)  # "free"（当日の無料枠）か "purchased"（購入分）
+    reason = db.Column(db.String(20), nullable=False)  # "hint"（消費）, "refund"（生成に失敗して返した）
+    kind = db.Column(db.String(20))  # ヒントの種類（HintCacheEntry.kind と同じ）
+    problem_id = db.Column(db.Integer)
+    request_id = db.Column(db.String(64))  # ブラウザがヒントボタンを押すごとに作る ID（無ければ NULL）
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class TextBlob(db.Model):
+    # 提出コード・ヒント文の本体。内容の sha256 で引き、同じ内容は1行だけ持つ（形式は textblobs を参照）
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)  # 元の UTF-8 のバイト数
+    codec = db.Column(db.String(10), nullable=False)  # "zlib" か "raw"
+    data = db.Column(db.LargeBinary, nullable=False)
 
 with app.app_context():
+    event.listen(db.engine, "connect", _set_sqlite_pragmas)
+    # 複数の gunicorn ワーカーが同時に起動しても、テーブル作成と初期データ投入は1つずつ行う
+    startup_lock = open(f"{db.engine.url.database}.startup.lock", "w")
+    fcntl.flock(startup_lock, fcntl.LOCK_EX)
     db.create_all()
+    admission_tables.create_all(db.engine)
+    upgrade_schema(db.engine)
     if not Problem.query.first():
         p1 = Problem(
             title="Hello World",
@@ -91,7 +389,7 @@ with app.app_context():
         db.session.add(p1)
         db.session.commit()
 
-        t1 = TestCase(problem_id=p1.id, input_data="", expected_output="Hello, World!\n")
+        t1 = new_test_case(p1.id, 0, testdata.put_text(""), testdata.put_text("Hello, World!\n"), is_sample=True)
         db.session.add(t1)
 
         p2 = Problem(
@@ -101,10 +399,303 @@ with app.app_context():
         db.session.add(p2)
         db.session.commit()
 
-        t2_1 = TestCase(problem_id=p2.id, input_data="2 3\n", expected_output="5\n")
-        t2_2 = TestCase(problem_id=p2.id, input_data="10 20\n", expected_output="30\n")
+        t2_1 = new_test_case(p2.id, 0, testdata.put_text("2 3\n"), testdata.put_text("5\n"), is_sample=True)
+        t2_2 = new_test_case(p2.id, 1, testdata.put_text("10 20\n"), testdata.put_text("30\n"), is_sample=True)
         db.session.add_all([t2_1, t2_2])
         db.session.commit()
+    # 起動時に開いた接続を fork 後のワーカーに引き継がない
+    db.session.remove()
+    db.engine.dispose()
+    startup_lock.close()
+
+def get_version(name):
+    stamp = db.session.get(VersionStamp, name)
+    return stamp.version if stamp else 0
+
+def get_version_stamp(name):
+    """(バージョン番号, 最後に進めた日時) を返す。一度も進めていなければ (0, None)。"""
+    stamp = db.session.get(VersionStamp, name)
+    if stamp is None:
+        return 0, None
+    updated_at = stamp.updated_at.replace(tzinfo=timezone.utc) if stamp.updated_at else None
+    return stamp.version, updated_at
+
+def bump_version(name):
+    """バージョン番号を1つ進める（コミットは呼び出し側で行う）。"""
+    stamp = db.session.get(VersionStamp, name)
+    if stamp is None:
+        stamp = VersionStamp(name=name, version=0)
+        db.session.add(stamp)
+    stamp.version += 1
+    stamp.updated_at = datetime.now(timezone.utc)
+
+# 問題一覧・問題ページのデータと、描画済みページのキャッシュ。
+# キーにカタログのバージョンを含めるので、管理画面で問題を変えれば全ワーカーで自然に外れる
+catalog_cache = LRUCache(maxsize=1024)
+page_cache = LRUCache(maxsize=256)
+
+def invalidate_catalog():
+    """問題の追加・編集・削除のあとに呼ぶ（コミットは呼び出し側で行う）。"""
+    bump_version("catalog")
+
+def problem_list():
+    """一覧ページ用の問題（id と title だけ）。"""
+    version = get_version("catalog")
+    problems = catalog_cache.get(("list", version))
+    if problems is None:
+        problems = [
+            {"id": problem.id, "title": problem.title}
+            for problem in Problem.query.options(load_only(Problem.id, Problem.title)).order_by(Problem.id)
+        ]
+        catalog_cache.set(("list", version), problems)
+    return problems
+
+# 問題ページに出すサンプルの最大文字数
+SAMPLE_PREVIEW_LIMIT = 4096
+
+def problem_for_page(problem_id):
+    """問題ページに出す問題文とサンプル。無ければ None。"""
+    version = get_version("catalog")
+    problem = catalog_cache.get(("problem", problem_id, version))
+    if problem is None:
+        found = db.session.get(Problem, problem_id)
+        if found is None:
+            return None
+        problem = {
+            "id": found.id,
+            "title": found.title,
+            "description": found.description,
+            # 大きなテストデータもあるので、ページに出すのはサンプルの先頭だけ
+            "samples": [
+                {"input": test.input_preview(SAMPLE_PREVIEW_LIMIT), "expected": test.expected_preview(SAMPLE_PREVIEW_LIMIT)}
+                for test in found.test_cases if test.is_sample
+            ],
+        }
+        catalog_cache.set(("problem", problem_id, version), problem)
+    return problem
+
+def _cached_render(name, version, render):
+    """匿名ユーザー向けの描画結果を返す。無ければ render() して保存する。"""
+    key = f"{name}:{version}"
+    body = page_cache.get(key)
+    if body is None and app.config['PAGE_CACHE_PERSIST']:
+        entry = db.session.get(PageCacheEntry, key)
+        if entry is not None:
+            body = entry.body
+            page_cache.set(key, body)
+    if body is None:
+        body = render()
+        page_cache.set(key, body)
+        if app.config['PAGE_CACHE_PERSIST']:
+            try:
+                PageCacheEntry.query.filter_by(name=name).delete()
+                db.session.add(PageCacheEntry(key=key, name=name, body=body))
+                db.session.commit()
+            except IntegrityError:
+                # 別のワーカーが同じページを先に保存した
+                db.session.rollback()
+    return body
+
+def catalog_page(name, render):
+    """
+    問題カタログから作るページを返す。
+    未ログインなら描画結果をカタログのバージョンごとにキャッシュする。
+    どちらの場合も ETag をつけ、ブラウザの条件付き GET には 304 を返す。
+    """
+    version, updated_at = get_version_stamp("catalog")
+    if current_user.is_authenticated:
+        # ログイン中はユーザーごとに中身が違う（解答済みの印など）ので毎回描画する
+        body = render()
+    else:
+        body = _cached_render(name, version, render)
+    response = make_response(body)
+    response.set_etag(hashlib.sha256(body.encode("utf-8")).hexdigest()[:32])
+    if not current_user.is_authenticated and updated_at is not None:
+        response.last_modified = updated_at
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+verdict_cache = LRUCache(maxsize=app.config['VERDICT_CACHE_SIZE'])
+
+# 実行環境の混み具合で結果が変わりうるものはキャッシュしない
+UNCACHEABLE_STATUSES = (TIME_LIMIT_EXCEEDED, MEMORY_LIMIT_EXCEEDED)
+
+def verdict_cache_key(user_code, problem_id, fail_fast):
+    testset_version = get_version(f"testset:{problem_id}")
+    raw_key = f"{code_hash(user_code)}:{problem_id}:{testset_version}:{int(fail_fast)}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+def lookup_verdict(key, user_code, problem_description):
+    """キャッシュ済みの採点結果を返す。無ければ None。"""
+    judged = verdict_cache.get(key)
+    if judged is None and app.config['VERDICT_CACHE_PERSIST']:
+        entry = db.session.get(VerdictCacheEntry, key)
+        if entry is not None:
+            entry.last_used_at = datetime.now(timezone.utc)
+            db.session.commit()
+            judged = json.loads(entry.verdict)
+            verdict_cache.set(key, judged)
+    if judged is None:
+        return None
+    # 正規化前のコードは提出ごとに違いうるので、ヒント用のパラメータは今回の提出に合わせる
+    hint_params = dict(judged["hint_params"])
+    if hint_params:
+        hint_params["user_code"] = user_code
+        hint_params["problem_description"] = problem_description
+    return dict(judged, hint_params=hint_params)
+
+def store_verdict(key, problem_id, judged):
+    """採点結果をキャッシュに入れる。"""
+    if any(result["status"] in UNCACHEABLE_STATUSES for result in judged["results"]):
+        return
+    verdict_cache.set(key, judged)
+    if app.config['VERDICT_CACHE_PERSIST']:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=app.config['VERDICT_CACHE_TTL'])
+        try:
+            db.session.merge(VerdictCacheEntry(key=key, problem_id=problem_id, verdict=json.dumps(judged)))
+            _trim_verdict_cache(cutoff)
+            db.session.commit()
+        except IntegrityError:
+            # 別のワーカーが同じ結果を先に保存した
+            db.session.rollback()
+
+def _trim_verdict_cache(cutoff):
+    """期限切れの採点結果と、件数の上限を超えた分を最後に使われた日時の古い順に消す。"""
+    VerdictCacheEntry.query.filter(VerdictCacheEntry.created_at < cutoff).delete()
+    excess = VerdictCacheEntry.query.count() - app.config['VERDICT_CACHE_PERSIST_SIZE']
+    if excess > 0:
+        oldest = db.session.query(VerdictCacheEntry.key).order_by(VerdictCacheEntry.last_used_at).limit(excess)
+        VerdictCacheEntry.query.filter(VerdictCacheEntry.key.in_(oldest.scalar_subquery())).delete(
+            synchronize_session=False)
+
+def invalidate_verdicts(problem_id):
+    """テストケースが変わった問題の採点結果キャッシュを無効にする（コミットは呼び出し側で行う）。"""
+    bump_version(f"testset:{problem_id}")
+    VerdictCacheEntry.query.filter_by(problem_id=problem_id).delete()
+
+hint_cache = LRUCache(maxsize=1024, ttl=app.config['HINT_CACHE_TTL'])
+hint_flight = SingleFlight()
+
+def normalize_error(message):
+    """キャッシュのキー用に、空白や改行の違いをならしたエラーメッセージ。"""
+    return " ".join((message or "").split())
+
+def hint_cache_key(kind, problem_id, user_code, error_message):
+    problem_version = get_version(f"hints:{problem_id}")
+    error_hash = hashlib.sha256(normalize_error(error_message).encode("utf-8")).hexdigest()
+    raw_key = f"{kind}:{problem_id}:{problem_version}:{code_hash(user_code)}:{error_hash}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+def lookup_hint(key):
+    """キャッシュ済みのヒントを返す。無いか期限切れなら None。"""
+    hint = hint_cache.get(key)
+    if hint is not None:
+        return hint
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=app.config['HINT_CACHE_TTL'])
+    entry = HintCacheEntry.query.filter(HintCacheEntry.key == key, HintCacheEntry.created_at >= cutoff).first()
+    if entry is None:
+        return None
+    entry.last_used_at = datetime.now(timezone.utc)
+    db.session.commit()
+    hint_cache.set(key, entry.hint)
+    return entry.hint
+
+def store_hint(key, kind, problem_id, hint):
+    """ヒントをキャッシュに入れる。"""
+    hint_cache.set(key, hint)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=app.config['HINT_CACHE_TTL'])
+    try:
+        db.session.merge(HintCacheEntry(key=key, kind=kind, problem_id=problem_id, hint=hint))
+        _trim_hint_cache(cutoff)
+        db.session.commit()
+    except IntegrityError:
+        # 別のワーカーが同じヒントを先に保存した
+        db.session.rollback()
+
+def cached_hint(kind, problem_id, user_code, error_message, generate):
+    """
+    ヒントをキャッシュから返す。無ければ generate() で作って保存する。
+    同じキーの要求が同時に来たら、GPT を呼ぶのは1回だけにする。
+    """
+    key = hint_cache_key(kind, problem_id, user_code, error_message)
+
+    def load_or_generate():
+        hint = lookup_hint(key)
+        if hint is None:
+            hint = generate()
+            store_hint(key, kind, problem_id, hint)
+        return hint
+
+    return hint_cache.get(key) or hint_flight.do(key, load_or_generate)
+
+def _trim_hint_cache(cutoff):
+    """期限切れのヒントと、件数の上限を超えた分を最後に使われた日時の古い順に消す。"""
+    HintCacheEntry.query.filter(HintCacheEntry.created_at < cutoff).delete()
+    excess = HintCacheEntry.query.count() - app.config['HINT_CACHE_SIZE']
+    if excess > 0:
+        oldest = db.session.query(HintCacheEntry.key).order_by(HintCacheEntry.last_used_at).limit(excess)
+        HintCacheEntry.query.filter(HintCacheEntry.key.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+
+def invalidate_hints(problem_id):
+    """問題文が変わった問題のヒントキャッシュを無効にする（コミットは呼び出し側で行う）。"""
+    bump_version(f"hints:{problem_id}")
+    HintCacheEntry.query.filter_by(problem_id=problem_id).delete()
+
+text_cache = LRUCache(maxsize=app.config['TEXT_CACHE_SIZE'])
+
+def store_text(body):
+    """本体を text_blob に保存して sha256 を返す（既にあれば何もしない。コミットは呼び出し側で行う）。"""
+    digest, size, codec, data = textblobs.pack(body)
+    db.session.execute(
+        insert(TextBlob).prefix_with("OR IGNORE").values(hash=digest, size=size, codec=codec, data=data)
+    )
+    return digest
+
+def load_texts(hashes):
+    """sha256 から本体を引いて {sha256: 本体} を返す。キャッシュに無いものだけをまとめて DB から読む。"""
+    found, missing = {}, []
+    for digest in set(hashes):
+        body = text_cache.get(digest)
+        if body is None:
+            missing.append(digest)
+        else:
+            found[digest] = body
+    for start in range(0, len(missing), 500):
+        rows = db.session.query(TextBlob.hash, TextBlob.codec, TextBlob.data).filter(
+            TextBlob.hash.in_(missing[start:start + 500]))
+        for digest, codec, data in rows:
+            found[digest] = textblobs.unpack(codec, data)
+            text_cache.set(digest, found[digest])
+    return found
+
+def load_text(digest):
+    return load_texts([digest]).get(digest, "")
+
+def text_storage_stats():
+    """
+    提出コード・ヒント文の保存量（submission と text_blob を全部読むので、必要なときだけ呼ぶ）。
+    logical_bytes は提出ごとに本体を持っていた場合の大きさ、stored_bytes は text_blob に実際に置いている大きさ。
+    """
+    blobs, unique_bytes, stored_bytes = db.session.query(
+        func.count(), func.coalesce(func.sum(TextBlob.size), 0), func.coalesce(func.sum(func.length(TextBlob.data)), 0)
+    ).one()
+    logical_bytes = 0
+    for column in (Submission.code_hash, Submission.hint_hash):
+        logical_bytes += db.session.query(func.coalesce(func.sum(TextBlob.size), 0)).select_from(Submission).join(
+            TextBlob, TextBlob.hash == column).scalar()
+    page_size = db.session.execute(text("PRAGMA page_size")).scalar()
+    return {
+        "submissions": db.session.query(func.count(Submission.id)).scalar(),
+        "blobs": blobs,
+        "logical_bytes": logical_bytes,
+        "unique_bytes": unique_bytes,
+        "stored_bytes": stored_bytes,
+        "saved_ratio": round(1 - stored_bytes / logical_bytes, 4) if logical_bytes else 0.0,
+        "db_file_bytes": db.session.execute(text("PRAGMA page_count")).scalar() * page_size,
+        # VACUUM（flask compact-submissions）で返せる空きページ
+        "db_free_bytes": db.session.execute(text("PRAGMA freelist_count")).scalar() * page_size,
+    }
 
 def admin_required(func):
     @login_required
@@ -119,7 +710,10 @@ def admin_required(func):
 @admin_required
 def admin_problems():
     all_problems = Problem.query.all()
-    return render_template('admin_problems.html', problems=all_problems)
+    rejudges = RejudgeJob.query.order_by(RejudgeJob.created_at.desc()).limit(10).all()
+    # 保存量は提出全体を数えるので、?storage=1 で頼まれたときだけ計算する
+    storage = text_storage_stats() if request.args.get('storage') == '1' else None
+    return render_template('admin_problems.html', problems=all_problems, rejudges=rejudges, storage=storage)
 
 @app.route('/feedback', methods=['POST'])
 @login_required  # ログインしていないと送信できないようにする
@@ -146,6 +740,83 @@ def submit_feedback():
     db.session.commit()
     return jsonify({'status': 'success'})
 
+@app.route('/admin/judge_stats')
+@admin_required
+def admin_judge_stats():
+    # このワーカープロセスでの採点の受け付け状況と、キューの長さ・待ち時間
+    return jsonify(judge_admission.stats())
+
+@app.route('/admin/hint_stats')
+@admin_required
+def admin_hint_stats():
+    # このワーカープロセスでのヒント生成の統計（種類ごと）
+    return jsonify(hint_stats())
+
+# 管理画面の編集欄にそのまま出すテストデータの最大バイト数（超えるものはファイルで置き換える）
+EDIT_INLINE_LIMIT = 64 * 1024
+
+_CASE_FIELD = re.compile(r'^(?:input_data|expected_output|input_file|expected_file|input_hash|output_hash)(\d+)$')
+
+def _test_data_from_form(i, kind):
+    """
+    フォームの i 番目のテストケースの入力（kind="input"）か期待する出力（kind="output"）を
+    testdata に保存し、(sha256, バイト数) を返す。無ければ None。
+    アップロードされたファイル > 保存済みのまま残すもの（大きなデータ）> 入力欄 の順に使う。
+    """
+    file_field, text_field = ('input_file', 'input_data') if kind == 'input' else ('expected_file', 'expected_output')
+    upload = request.files.get(f'{file_field}{i}')
+    if upload and upload.filename:
+        return testdata.put_stream(upload.stream)
+    kept = request.form.get(f'{kind}_hash{i}', '')
+    if kept and testdata.exists(kept):
+        return kept, testdata.blob_path(kept).stat().st_size
+    text = request.form.get(f'{text_field}{i}', '').strip()
+    return testdata.put_text(text) if text else None
+
+def _test_cases_from_form(problem_id):
+    """
+    フォームからテストケースを作る。件数に上限はない。
+    テストケース1の期待する出力が無ければ ValueError。
+    """
+    indexes = sorted({int(m.group(1)) for key in list(request.form) + list(request.files)
+                      for m in [_CASE_FIELD.match(key)] if m})
+    cases = []
+    for i in indexes:
+        input_ref = _test_data_from_form(i, 'input')
+        output_ref = _test_data_from_form(i, 'output')
+        if not cases and output_ref is None:
+            raise ValueError('テストケース1は必須です。')
+        if input_ref is None and output_ref is None:
+            continue
+        cases.append(new_test_case(
+            problem_id,
+            len(cases),
+            input_ref or testdata.put_text(''),
+            output_ref or testdata.put_text(''),
+            is_sample=request.form.get(f'is_sample{i}') == '1',
+        ))
+    if not cases:
+        raise ValueError('テストケース1は必須です。')
+    return cases
+
+def _test_cases_for_form(problem):
+    """編集画面に出すテストケース。小さいものは中身を、大きいものはサイズだけを渡す。"""
+    cases = []
+    for test in problem.test_cases:
+        case = {"is_sample": test.is_sample}
+        for kind, digest, size, inline in (
+            ("input", test.input_hash, test.input_size, test.input_data),
+            ("output", test.output_hash, test.output_size, test.expected_output),
+        ):
+            if digest is None:
+                case[kind] = {"text": inline or "", "hash": None, "size": len((inline or "").encode("utf-8"))}
+            elif size <= EDIT_INLINE_LIMIT:
+                case[kind] = {"text": testdata.read_preview(digest, EDIT_INLINE_LIMIT), "hash": None, "size": size}
+            else:
+                case[kind] = {"text": None, "hash": digest, "size": size}
+        cases.append(case)
+    return cases
+
 @app.route('/admin/problems/add', methods=['GET', 'POST'])
 @admin_required
 def admin_add_problem():
@@ -159,26 +830,15 @@ def admin_add_problem():
         
         new_problem = Problem(title=title, description=description)
         db.session.add(new_problem)
-        db.session.commit()
-        
-        for i in range(1, 4):
-            input_key = f'input_data{i}'
-            expected_output_key = f'expected_output{i}'
-
-            input_data = request.form.get(input_key, '').strip()
-            expected_output = request.form.get(expected_output_key, '').strip()
-
-            if i == 1 and not expected_output:
-                flash(f'テストケース1は必須です。')
-                return redirect(request.url)
-
-            if input_data or expected_output:
-                testcase = TestCase(
-                    problem_id=new_problem.id,
-                    input_data=input_data,
-                    expected_output=expected_output
-                )
-                db.session.add(testcase)
+        db.session.flush()
+
+        try:
+            db.session.add_all(_test_cases_from_form(new_problem.id))
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(request.url)
+        invalidate_catalog()
         db.session.commit()
 
         flash('問題を追加しました。')
@@ -198,29 +858,25 @@ def admin_edit_problem(problem_id):
 
         # 既存のテストケースを一旦削除し、新しいデータを登録
         TestCase.query.filter_by(problem_id=problem_id).delete()
+        try:
+            db.session.add_all(_test_cases_from_form(problem_id))
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(request.url)
 
-        for i in range(1, 4):
-            input_data = request.form.get(f'input_data{i}', '').strip()
-            expected_output = request.form.get(f'expected_output{i}', '').strip()
-
-            # テストケース1は必須
-            if i == 1 and not expected_output:
-                flash('テストケース1は必須です。')
-                return redirect(request.url)
-
-            if input_data or expected_output:
-                new_testcase = TestCase(
-                    problem_id=problem_id,
-                    input_data=input_data,
-                    expected_output=expected_output
-                )
-                db.session.add(new_testcase)
-
+        invalidate_verdicts(problem_id)
+        invalidate_hints(problem_id)
+        invalidate_catalog()
         db.session.commit()
         flash('問題を更新しました。')
+        if request.form.get('rejudge') == '1':
+            # テストケースが変わったので、これまでの提出の判定を作り直す
+            start_rejudge(problem_id)
+            flash('これまでの提出の再採点を始めました。')
         return redirect(url_for('admin_problems'))
 
-    return render_template('admin_edit_problem.html', problem=problem)
+    return render_template('admin_edit_problem.html', problem=problem, cases=_test_cases_for_form(problem))
 
 # 問題削除
 @app.route('/admin/problems/delete/<int:problem_id>', methods=['POST'])
@@ -230,10 +886,95 @@ def admin_delete_problem(problem_id):
     # 関連するテストケースも削除
     TestCase.query.filter_by(problem_id=problem_id).delete()
     db.session.delete(problem)
+    invalidate_verdicts(problem_id)
+    invalidate_hints(problem_id)
+    invalidate_catalog()
     db.session.commit()
     flash('問題を削除しました。')
     return redirect(url_for('admin_problems'))
 
+def import_problems(problems):
+    """
+    packs.read_pack の結果をまとめて登録する。全体を1つのトランザクションで書き、登録した問題数を返す。
+    途中で失敗すれば1問も登録されない（保存済みのテストデータは gc-testdata で消える）。
+    """
+    created = [Problem(title=problem["title"], description=problem["description"]) for problem in problems]
+    db.session.add_all(created)
+    db.session.flush()
+    rows = [
+        {
+            "problem_id": new_problem.id,
+            "position": position,
+            "is_sample": case["sample"],
+            "input_hash": case["input"][0],
+            "input_size": case["input"][1],
+            "output_hash": case["output"][0],
+            "output_size": case["output"][1],
+        }
+        for new_problem, problem in zip(created, problems)
+        for position, case in enumerate(problem["cases"])
+    ]
+    # テストケースは ORM のオブジェクトを作らず、executemany でまとめて入れる
+    db.session.execute(insert(TestCase), rows)
+    invalidate_catalog()
+    db.session.commit()
+    return len(created)
+
+def problems_for_export(problem_ids=None):
+    """
+    エクスポートする問題の一覧（packs.write_pack に渡す形）。
+    テストデータの中身は含まないので、ストリーミングを始める前に DB から読み切っておける。
+    """
+    query = Problem.query.options(selectinload(Problem.test_cases)).order_by(Problem.id)
+    if problem_ids:
+        query = query.filter(Problem.id.in_(problem_ids))
+    return [
+        {
+            "id": problem.id,
+            "title": problem.title,
+            "description": problem.description,
+            "cases": [
+                {"input": test.input_hash, "output": test.output_hash, "sample": test.is_sample}
+                for test in problem.test_cases
+            ],
+        }
+        for problem in query
+    ]
+
+# 問題パックの取り込み
+@app.route('/admin/problems/import', methods=['POST'])
+@admin_required
+def admin_import_problems():
+    pack = request.files.get('pack')
+    if not pack or not pack.filename:
+        flash('問題パック（zip）を選んでください。')
+        return redirect(url_for('admin_problems'))
+    try:
+        count = import_problems(packs.read_pack(pack.stream))
+    except packs.PackError as e:
+        for error in e.errors[:10]:
+            flash(error)
+        if len(e.errors) > 10:
+            flash(f'ほか {len(e.errors) - 10} 件の問題があります。')
+        return redirect(url_for('admin_problems'))
+    flash(f'{count} 問を追加しました。')
+    return redirect(url_for('admin_problems'))
+
+# 問題パックの書き出し（?ids=1,2,3 で問題を絞れる）
+@app.route('/admin/problems/export')
+@admin_required
+def admin_export_problems():
+    try:
+        problem_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        abort(400)
+    problems = problems_for_export(problem_ids)
+    return Response(
+        packs.write_pack(problems, testdata.open_blob),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename="problems.zip"'},
+    )
+
 @login_manager.user_loader
 def load_user(user_id):
     try:
@@ -244,7 +985,7 @@ def load_user(user_id):
 @app.route('/support')
 def support():
     # support.html を templates フォルダに置いておく
-    return render_template('support.html')
+    return catalog_page("support", lambda: render_template('support.html'))
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -285,8 +1026,8 @@ def login():
 
 @app.route('/problems')
 def show_problems():
-    all_problems = Problem.query.all()
-    return render_template('problems.html', problems=all_problems)
+    return catalog_page("problems", lambda: render_template(
+        'problems.html', problems=problem_list(), solved_problems_ids=solved_problem_ids(current_user)))
 
 @app.route("/logout")
 @login_required
@@ -298,131 +1039,562 @@ def logout():
 
 @app.route('/')
 def index():
-    all_problems = Problem.query.all()
-    solved_problems_ids = set()
-    if current_user.is_authenticated:
-        solved = db.session.query(distinct(Submission.problem_id)).filter_by(
-            user_id=current_user.id, status="Accepted"
-        ).all()
-        # solved は [(1,), (3,), ...] のようなタプルのリストになるので、setに変換
-        solved_problems_ids = {pid for (pid,) in solved}
-    return render_template('index.html', problems=all_problems, current_user=current_user, solved_problems_ids=solved_problems_ids)
+    return catalog_page("index", lambda: render_template(
+        'index.html', problems=problem_list(), current_user=current_user, solved_problems_ids=solved_problem_ids(current_user)))
 
 
 @app.route('/problem/<int:problem_id>')
 def problem(problem_id):
-    problem = Problem.query.get_or_404(problem_id)
+    problem = problem_for_page(problem_id)
+    if problem is None:
+        abort(404)
     # GETの場合は hint_prompt を空文字列にしておく
-    return render_template('problem.html', problem=problem, problem_id=problem.id, user_code="", hint_params={})
+    return catalog_page(f"problem:{problem_id}", lambda: render_template(
+        'problem.html', problem=problem, problem_id=problem["id"], user_code="", hint_params={}))
+
+judge_queue = JudgeQueue()
+# 採点キューの前の受け付け係。1人の連打や混雑は、キューに積まずにすぐ 429 で断る。
+# 上限は SQLite で数えるので、gunicorn のワーカー全体で共通
+with app.app_context():
+    judge_admission = AdmissionController(judge_queue, db.engine)
+
+def _judge_key():
+    """公平に順番を回す単位。ログインしていなければ接続元の IP ごと。"""
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    # Fly のプロキシが付けるヘッダー。無ければ直接の接続元
+    return f"ip:{request.headers.get('Fly-Client-IP') or request.remote_addr}"
+
+def _judge_rejected(e, problem_id, user_code):
+    """受け付けなかった提出への 429 応答。入力したコードは消さずに返す。"""
+    if e.reason == "busy":
+        message = f"採点が混み合っています。{e.retry_after}秒ほど待ってからもう一度提出してください。"
+    else:
+        message = f"続けて提出しすぎです。{e.retry_after}秒ほど待ってからもう一度提出してください。"
+    if _wants_json():
+        response = jsonify({
+            "status": "busy",
+            "reason": e.reason,
+            "message": message,
+            "retry_after": e.retry_after,
+            "queue_depth": judge_admission.queued(),
+        })
+    else:
+        response = make_response(render_template(
+            'problem.html', problem=problem_for_page(problem_id), problem_id=problem_id,
+            user_code=user_code, hint_params={}, busy_message=message))
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# 古い採点ジョブを残しておく期間
+JUDGE_JOB_RETENTION = timedelta(days=1)
+
+def _finish_judge_job(job, judged):
+    job.total = len(judged["results"])
+    job.results = json.dumps({str(i): result for i, result in enumerate(judged["results"])})
+    job.overall = judged["overall"]
+    job.hint_prompt = judged["hint_prompt"]
+    job.hint_params = json.dumps(judged["hint_params"])
+    job.status = "done"
+    if job.submission_id:
+        submission = db.session.get(Submission, job.submission_id)
+        submission.status = judged["overall"]
+        submission.hint_hash = store_text(judged["hint_prompt"]) if judged["hint_prompt"] else None
+        _record_resource_usage(submission, judged)
+        _record_problem_status(submission)
+
+def _record_problem_status(submission):
+    """
+    提出の判定を UserProblemStatus に反映する（コミットは呼び出し側で行う）。
+    複数のワーカーから同時に来ても数え漏れないよう、1つの UPSERT で更新する。
+    """
+    accepted = submission.status == "Accepted"
+    submitted_at = submission.submission_time
+    table = UserProblemStatus.__table__
+    stmt = sqlite_insert(table).values(
+        user_id=submission.user_id,
+        problem_id=submission.problem_id,
+        best_status=submission.status,
+        attempts=1,
+        first_accepted_at=submitted_at if accepted else None,
+        last_submitted_at=submitted_at,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.problem_id],
+        set_={
+            "best_status": case((table.c.best_status == "Accepted", "Accepted"), else_=stmt.excluded.best_status),
+            "attempts": table.c.attempts + 1,
+            "first_accepted_at": func.coalesce(table.c.first_accepted_at, stmt.excluded.first_accepted_at),
+            "last_submitted_at": stmt.excluded.last_submitted_at,
+        },
+    )
+    db.session.execute(stmt)
+
+def solved_problem_ids(user):
+    """ユーザーが解いた問題の ID の集合。"""
+    if not user.is_authenticated:
+        return set()
+    rows = db.session.query(UserProblemStatus.problem_id).filter_by(user_id=user.id, best_status="Accepted")
+    return {problem_id for (problem_id,) in rows}
+
+def _record_resource_usage(submission, judged):
+    submission.max_wall_time = judged.get("max_wall_time")
+    submission.max_cpu_time = judged.get("max_cpu_time")
+    submission.peak_memory_kb = judged.get("peak_memory_kb")
+
+def _run_judge_job(job_id, user_code, problem_description, test_cases, fail_fast=False, cache_key=None):
+    """
+    キューのワーカースレッドで採点を行い、テストケースが終わるたびに
+    JudgeJob に結果を書き込む。最後に Submission の status を更新する。
+    """
+    with app.app_context():
+        job = db.session.get(JudgeJob, job_id)
+        job.status = "running"
+        db.session.commit()
+        partial = {}
+
+        def on_result(index, result):
+            partial[str(index)] = result
+            job.results = json.dumps(partial)
+            db.session.commit()
+
+        try:
+            judged = judge_submission(user_code, problem_description, test_cases, on_result=on_result, fail_fast=fail_fast)
+        except Exception:
+            db.session.rollback()
+            job.status = "error"
+            if job.submission_id:
+                db.session.get(Submission, job.submission_id).status = "Error"
+            db.session.commit()
+            raise
+
+        _finish_judge_job(job, judged)
+        db.session.commit()
+        if cache_key:
+            store_verdict(cache_key, job.problem_id, judged)
+
+def _wants_json():
+    return request.accept_mimetypes.best == 'application/json'
 
 @app.route('/submit/<int:problem_id>', methods=['POST'])
 def submit(problem_id):
     problem = Problem.query.get_or_404(problem_id)
 
     user_code = request.form['code']
-    results = []
-    all_passed = True
-    hint_params = {}  # ヒント生成に使うパラメータを保持する辞書
-    hint_prompt = None  # ヒント取得を促すメッセージを保持する変数
-    # 静的チェックを実行
-    forbidden = check_forbidden_operations(user_code)
-    if forbidden:
-        error_type, message = forbidden
-        hint_prompt = "禁止操作が検出されました。ヒントをもらいますか？"
-        hint_params = {
-            "error_type": error_type,
-            "error_message": message,
-            "user_code": user_code,
-            "problem_description": problem.description
-        }
-        result = {
-            "input": "",
-            "expected": "",
-            "output": "",
-            "error": message,
-            "status": error_type  # Forbidden Command, File Operation, or Exit Function
-        }
-        results.append(result)
-        all_passed = False
-    else:
-        # 各テストケースについて実行
-        for test in problem.test_cases:
-            input_data = test.input_data
-            expected_output = test.expected_output
-
-            try:
-                stdout, stderr, returncode = run_code(user_code, input_data)
-            except MemoryError:
-                stdout, stderr, returncode = "", "Memory Overuse", -1
-
-            # スタックトレースからユーザーコード関連部分だけを抽出
-            short_stderr = extract_relevant_error(stderr)
-            stdout_norm = stdout.strip()
-            expected_norm = expected_output.strip()
-
-            if short_stderr:
-                if not hint_params:
-                    hint_prompt = "エラーが発生しました。ヒントをもらいますか？"
-                    hint_params = {
-                        "error_type": "Error",
-                        "error_message": short_stderr,
-                        "user_code": user_code,
-                        "problem_description": problem.description,
-                        "input_example": input_data,
-                        "output_example": expected_output
-                    }
-                result = {
-                    "input": input_data,
-                    "expected": expected_output,
-                    "output": stdout,
-                    "error": short_stderr,
-                    "status": "Error"
-                }
-                all_passed = False
-            elif stdout_norm != expected_norm:
-                if not hint_params:
-                    hint_prompt = "不正解でした。ヒントをもらいますか？"
-                    hint_params = {
-                        "error_type": "Wrong Answer",
-                        "error_message": f"Expected: {expected_norm}\nGot: {stdout_norm}",
-                        "user_code": user_code,
-                        "problem_description": problem.description,
-                        "input_example": input_data,
-                        "output_example": expected_output
-                    }
-                result = {
-                    "input": input_data,
-                    "expected": expected_output,
-                    "output": stdout,
-                    "error": "",
-                    "status": "Wrong Answer"
-                }
-                all_passed = False
-            else:
-                result = {
-                    "input": input_data,
-                    "expected": expected_output,
-                    "output": stdout,
-                    "error": "",
-                    "status": "Accepted"
-                }
-            results.append(result)
-
-    overall = "Accepted" if all_passed else "Failed"
-
-    # ループ終了後、全体の判定を得た後
+    # 最初の失敗で残りのテストケースを打ち切るか
+    fail_fast = request.form.get('fail_fast') == '1'
+    test_cases = [(test.input_source(), test.expected_source()) for test in problem.test_cases]
+
+    # 同じコードを同じテストセットで採点済みなら、その結果を使う
+    cache_key = verdict_cache_key(user_code, problem_id, fail_fast)
+    cached = lookup_verdict(cache_key, user_code, problem.description)
+
+    # キャッシュに無いものだけが実際にサンドボックスを動かすので、受け付け制御もそこだけにかける
+    judge_key = _judge_key()
+    reservation = None
+    if cached is None:
+        try:
+            reservation = judge_admission.admit(judge_key)
+        except Rejected as e:
+            return _judge_rejected(e, problem_id, user_code)
+
+    if _wants_json():
+        try:
+            return _submit_async(problem, user_code, test_cases, fail_fast, cache_key, cached, judge_key, reservation)
+        except Exception:
+            # キューに積めなかった予約は、ほかの提出の邪魔にならないようすぐ消す
+            if reservation is not None:
+                judge_admission.release(reservation)
+            raise
+
+    # JavaScript が使えない場合は採点が終わるまでこのリクエストで待つ。
+    # 採点自体は同じキューに積み、ほかの人の提出と順番に処理する
+    judged = cached
+    if judged is None:
+        judged = judge_admission.submit(
+            reservation, judge_submission, user_code, problem.description, test_cases, None, fail_fast, key=judge_key
+        ).result()
+        store_verdict(cache_key, problem_id, judged)
+    results = judged["results"]
+    overall = judged["overall"]
+    hint_prompt = judged["hint_prompt"]
+    hint_params = judged["hint_params"]
+
+    # 全体の判定を得た後
     if current_user.is_authenticated:
         new_submission = Submission(
             user_id=current_user.id,
             problem_id=problem_id,
             submission_time=datetime.now(timezone.utc),
             status=overall,
-            code=user_code,
-            hint=hint_prompt if hint_prompt else ""
+            code_hash=store_text(user_code),
+            hint_hash=store_text(hint_prompt) if hint_prompt else None,
         )
+        _record_resource_usage(new_submission, judged)
         db.session.add(new_submission)
+        _record_problem_status(new_submission)
         db.session.commit()
-    return render_template('problem.html', problem=problem, problem_id=problem_id, results=results, overall=overall, user_code=user_code, hint_prompt=hint_prompt, hint_params=hint_params)
+    return render_template('problem.html', problem=problem_for_page(problem_id), problem_id=problem_id, results=results, overall=overall, user_code=user_code, hint_prompt=hint_prompt, hint_params=hint_params)
+
+def _submit_async(problem, user_code, test_cases, fail_fast, cache_key, cached, judge_key, reservation):
+    """採点はキューに任せ、ジョブIDだけをすぐに返す。"""
+    submission = None
+    if current_user.is_authenticated:
+        submission = Submission(
+            user_id=current_user.id,
+            problem_id=problem.id,
+            submission_time=datetime.now(timezone.utc),
+            status="Judging",
+            code_hash=store_text(user_code),
+        )
+        db.session.add(submission)
+        db.session.flush()
+    job = JudgeJob(
+        id=uuid.uuid4().hex,
+        submission_id=submission.id if submission else None,
+        problem_id=problem.id,
+        total=len(test_cases)
+    )
+    db.session.add(job)
+    JudgeJob.query.filter(JudgeJob.created_at < datetime.now(timezone.utc) - JUDGE_JOB_RETENTION).delete()
+    if cached is not None:
+        _finish_judge_job(job, cached)
+    db.session.commit()
+    if cached is None:
+        judge_admission.submit(reservation, _run_judge_job, job.id, user_code, problem.description, test_cases,
+                               fail_fast, cache_key, key=judge_key)
+    return jsonify({
+        "job_id": job.id,
+        "status_url": url_for('submit_status', job_id=job.id)
+    }), 202
+
+@app.route('/submit/status/<job_id>')
+def submit_status(job_id):
+    """採点ジョブの進捗を返す。results には終わったテストケースだけが入る。"""
+    job = JudgeJob.query.get_or_404(job_id)
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "total": job.total,
+        "results": json.loads(job.results),
+        "overall": job.overall,
+        "hint_prompt": job.hint_prompt,
+        "hint_params": json.loads(job.hint_params) if job.hint_params else {}
+    })
+
+# 再採点で同時に採点する提出の数。サンドボックスは run_code.BACKGROUND_SANDBOXES 個までしか使わないので、
+# これを増やしても通常の提出の枠は減らない（並べておく提出が増えるだけ）
+REJUDGE_PARALLEL = int(os.environ.get("PDOJO_REJUDGE_PARALLEL", str(max(1, MAX_SANDBOXES // 2))))
+# 再採点の結果をまとめてコミットする提出数
+REJUDGE_BATCH = int(os.environ.get("PDOJO_REJUDGE_BATCH", "100"))
+# 件数がたまらなくても、この秒数ごとにコミットして進捗を見せる
+REJUDGE_FLUSH_INTERVAL = 2.0
+
+# 再採点は1プロセスで1つずつ。通常の採点キューとは分けて、提出の採点を待たせない
+rejudge_queue = JudgeQueue(workers=1)
+
+metrics.gauge("pdojo_judge_queue_depth", "採点待ちのジョブ数", lambda: {
+    (("queue", "judge"),): judge_queue.depth(),
+    (("queue", "rejudge"),): rejudge_queue.depth(),
+})
+metrics.gauge("pdojo_judge_jobs_running", "処理中の採点ジョブ数", lambda: {
+    (("queue", "judge"),): judge_queue.stats()["running"],
+    (("queue", "rejudge"),): rejudge_queue.stats()["running"],
+})
+metrics.gauge("pdojo_sandboxes_in_flight", "ユーザーコードを実行中のサンドボックス数", sandboxes_in_flight)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """全 gunicorn ワーカーを合計したメトリクス（Prometheus のテキスト形式）。"""
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def rejudge_target_query(problem_id, max_submission_id, statuses=None, user_id=None):
+    """再採点する提出（id, code_hash）を ID 順に返すクエリ。"""
+    query = (
+        db.session.query(Submission.id, Submission.code_hash)
+        .filter(Submission.problem_id == problem_id, Submission.id <= max_submission_id)
+        .filter(Submission.status.isnot(None), Submission.status != "Judging")
+        .order_by(Submission.id)
+    )
+    if statuses:
+        query = query.filter(Submission.status.in_(statuses))
+    if user_id:
+        query = query.filter(Submission.user_id == user_id)
+    return query
+
+def _rejudge_targets(job):
+    """
+    再採点する提出を、正規化したコードのハッシュごとにまとめる。
+    戻り値は {ハッシュ: [提出ID, ...]}（ID の昇順）。コードはメモリに持たず、採点するときに読み直す。
+    同じ内容のコードは text_blob で1つにまとまっているので、正規化のために展開するのは内容ごとに1回だけ。
+    """
+    query = rejudge_target_query(job.problem_id, job.max_submission_id, json.loads(job.statuses or "null"), job.user_id)
+    by_content = {}
+    for submission_id, digest in query.yield_per(500):
+        by_content.setdefault(digest, []).append(submission_id)
+    digests = [digest for digest in by_content if digest]
+    normalized = {None: code_hash("")}
+    for start in range(0, len(digests), 500):
+        for digest, code in load_texts(digests[start:start + 500]).items():
+            normalized[digest] = code_hash(code)
+    groups = {}
+    for digest, ids in by_content.items():
+        groups.setdefault(normalized.get(digest, digest), []).extend(ids)
+    for ids in groups.values():
+        ids.sort()
+    return groups
+
+def _recompute_problem_status(problem_id, user_ids):
+    """
+    再採点のあと、ユーザーごとの成績を提出から作り直す（コミットは呼び出し側で行う）。
+    再採点では Accepted が取り消されることもあるので、_record_problem_status のように積み上げず全体を数え直す。
+    """
+    if not user_ids:
+        return
+    params = {"problem_id": problem_id, **{f"u{i}": user_id for i, user_id in enumerate(user_ids)}}
+    placeholders = ", ".join(f":u{i}" for i in range(len(user_ids)))
+    db.session.execute(text(f"""
+        INSERT OR REPLACE INTO user_problem_status
+            (user_id, problem_id, best_status, attempts, first_accepted_at, last_submitted_at)
+        SELECT s.user_id, s.problem_id,
+               CASE WHEN MAX(s.status = 'Accepted') THEN 'Accepted' ELSE (
+                   SELECT l.status FROM submission l
+                   WHERE l.user_id = s.user_id AND l.problem_id = s.problem_id AND l.status != 'Judging'
+                   ORDER BY l.submission_time DESC, l.id DESC LIMIT 1
+               ) END,
+               COUNT(*),
+               MIN(CASE WHEN s.status = 'Accepted' THEN s.submission_time END),
+               MAX(s.submission_time)
+        FROM submission s
+        WHERE s.problem_id = :problem_id AND s.user_id IN ({placeholders})
+          AND s.status IS NOT NULL AND s.status != 'Judging'
+        GROUP BY s.user_id, s.problem_id
+    """), params)
+
+def _flush_rejudge(job, updates):
+    """たまった再採点の結果を1回のコミットで反映する。"""
+    if not updates:
+        return
+    ids = [update["id"] for update in updates]
+    before = dict(db.session.query(Submission.id, Submission.status).filter(Submission.id.in_(ids)))
+    # ヒント文は種類が少ないので、同じものは1回だけ保存する
+    hint_hashes = {hint: store_text(hint) for hint in {item["hint"] for item in updates} if hint}
+    rows = [{**{key: value for key, value in item.items() if key != "hint"},
+             "hint_hash": hint_hashes.get(item["hint"])} for item in updates]
+    db.session.execute(update(Submission), rows)
+    users = [user_id for (user_id,) in db.session.query(Submission.user_id).filter(Submission.id.in_(ids)).distinct()]
+    _recompute_problem_status(job.problem_id, users)
+    job.done += len(updates)
+    job.changed += sum(1 for item in updates if before.get(item["id"]) != item["status"])
+    db.session.commit()
+    updates.clear()
+
+def _rejudge_cancel_requested(job_id):
+    return bool(db.session.query(RejudgeJob.cancel_requested).filter_by(id=job_id).scalar())
+
+def _run_rejudge_job(job_id):
+    """
+    問題の提出を今のテストケースで採点し直す。
+    同じコードは1回だけ実行し、REJUDGE_PARALLEL 件ずつ並列に採点する。
+    結果は REJUDGE_BATCH 件ごとにコミットし、そのたびに取り消しの依頼を確かめる。
+    """
+    with app.app_context():
+        job = db.session.get(RejudgeJob, job_id)
+        if job is None or job.status != "queued":
+            return
+        problem = db.session.get(Problem, job.problem_id)
+        if problem is None:
+            job.status = "error"
+            job.error = "問題が見つかりません"
+            job.finished_at = datetime.now(timezone.utc)
+            db.session.commit()
+            return
+        test_cases = [(test.input_source(), test.expected_source()) for test in problem.test_cases]
+        description = problem.description
+
+        groups = _rejudge_targets(job)
+        job.status = "running"
+        job.total = sum(len(ids) for ids in groups.values())
+        job.unique_codes = len(groups)
+        db.session.commit()
+
+        pending = iter(groups.values())
+        updates = []
+        last_flush = time.monotonic()
+        cancelled = False
+        try:
+            with ThreadPoolExecutor(max_workers=REJUDGE_PARALLEL, thread_name_prefix="rejudge") as executor:
+                running = {}
+
+                def submit_next():
+                    ids = next(pending, None)
+                    if ids is None:
+                        return False
+                    # 採点のスレッドではセッションを使わないよう、コードはここで読んで渡す
+                    code = db.session.get(Submission, ids[0]).code
+                    # 判定が分かれば十分なので、最初の失敗で打ち切る
+                    future = executor.submit(judge_submission, code, description, test_cases, fail_fast=True,
+                                             background=True)
+                    running[future] = ids
+                    return True
+
+                # 取り消しにすぐ応じられるよう、投入するのは並列数の2倍まで
+                for _ in range(REJUDGE_PARALLEL * 2):
+                    if not submit_next():
+                        break
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        ids = running.pop(future)
+                        judged = future.result()
+                        for submission_id in ids:
+                            updates.append({
+                                "id": submission_id,
+                                "status": judged["overall"],
+                                "hint": judged["hint_prompt"] or "",
+                                "max_wall_time": judged.get("max_wall_time"),
+                                "max_cpu_time": judged.get("max_cpu_time"),
+                                "peak_memory_kb": judged.get("peak_memory_kb"),
+                            })
+                    # 件数がたまるか一定時間たったらコミットし、進捗に見えるようにする
+                    if len(updates) >= REJUDGE_BATCH or time.monotonic() - last_flush >= REJUDGE_FLUSH_INTERVAL:
+                        _flush_rejudge(job, updates)
+                        last_flush = time.monotonic()
+                    if not cancelled and _rejudge_cancel_requested(job_id):
+                        cancelled = True
+                    if cancelled:
+                        for future in running:
+                            future.cancel()
+                        # 実行中のものは終わるのを待って反映する
+                        running = {future: ids for future, ids in running.items() if not future.cancelled()}
+                        continue
+                    while len(running) < REJUDGE_PARALLEL * 2 and submit_next():
+                        pass
+            _flush_rejudge(job, updates)
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(RejudgeJob, job_id)
+            job.status = "error"
+            job.error = str(e)
+            job.finished_at = datetime.now(timezone.utc)
+            db.session.commit()
+            raise
+
+        cancelled = cancelled or _rejudge_cancel_requested(job_id)
+        job.status = "cancelled" if cancelled else "done"
+        job.finished_at = datetime.now(timezone.utc)
+        db.session.commit()
+
+def start_rejudge(problem_id, statuses=None, user_id=None):
+    """再採点ジョブを作ってキューに積み、ジョブを返す。"""
+    job = _new_rejudge_job(problem_id, statuses, user_id)
+    rejudge_queue.submit(_run_rejudge_job, job.id)
+    return job
+
+def _new_rejudge_job(problem_id, statuses=None, user_id=None):
+    job = RejudgeJob(
+        id=uuid.uuid4().hex,
+        problem_id=problem_id,
+        statuses=json.dumps(list(statuses)) if statuses else None,
+        user_id=user_id,
+        max_submission_id=db.session.query(func.max(Submission.id)).scalar() or 0,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+@app.route('/admin/problems/<int:problem_id>/rejudge', methods=['POST'])
+@admin_required
+def admin_rejudge_problem(problem_id):
+    Problem.query.get_or_404(problem_id)
+    statuses = [status for status in request.form.getlist('status') if status]
+    user_id = request.form.get('user_id', type=int)
+    job = start_rejudge(problem_id, statuses or None, user_id)
+    if _wants_json():
+        return jsonify(job.to_dict()), 202
+    flash('再採点を始めました。')
+    return redirect(url_for('admin_problems'))
+
+@app.route('/admin/rejudge/<job_id>')
+@admin_required
+def admin_rejudge_status(job_id):
+    return jsonify(RejudgeJob.query.get_or_404(job_id).to_dict())
+
+@app.route('/admin/rejudge/<job_id>/cancel', methods=['POST'])
+@admin_required
+def admin_rejudge_cancel(job_id):
+    job = RejudgeJob.query.get_or_404(job_id)
+    if job.status in ("queued", "running"):
+        job.cancel_requested = True
+        if job.status == "queued":
+            # まだ始まっていなければその場で取り消す（ワーカーは status を見て何もしない）
+            job.status = "cancelled"
+            job.finished_at = datetime.now(timezone.utc)
+        db.session.commit()
+    if _wants_json():
+        return jsonify(job.to_dict())
+    flash('再採点を取り消しました。')
+    return redirect(url_for('admin_problems'))
+
+def _hint_generators(code, problem_description, error_type, error_message):
+    """
+    ヒントの種類・キャッシュのキーに使うエラー内容・生成関数（通常版とストリーミング版）を決める。
+    禁止操作の判定は採点時の結果がコードのハッシュごとに残っているので、ここでは構文解析し直さない。
+    """
+    forbidden = check_forbidden_operations(code or '')
+    if forbidden:
+        return ('forbidden', forbidden[1],
+                lambda: get_forbidden_hint(code, forbidden[1]),
+                lambda: stream_forbidden_hint(code, forbidden[1]))
+    if error_type in ['Error', 'Wrong Answer']:
+        wrong_answer_info = f"Error Details: {error_message}"
+        return ('wrong_answer', wrong_answer_info,
+                lambda: get_wrong_answer(code, problem_description, "", "", wrong_answer_info),
+                lambda: stream_wrong_answer(code, problem_description, "", "", wrong_answer_info))
+    return ('general', error_message,
+            lambda: get_ai_hint(code, problem_description, "", "", error_message),
+            lambda: stream_ai_hint(code, problem_description, "", "", error_message))
+
+def _hint_error(e):
+    """ヒント生成の失敗を画面に返す形にする。"""
+    if isinstance(e, HintBusy):
+        return {
+            "status": "error",
+            "code": "busy",
+            "message": "ヒント機能が混み合っています。少し待ってからもう一度お試しください。"
+        }
+    error_msg = str(e)
+    app.logger.error("Hint generation failed: %s", error_msg)
+
+    # 💡 quota or 残高不足っぽい文言なら「quota」コードを返す
+    if "quota" in error_msg or "insufficient" in error_msg or "billing" in error_msg:
+        return {
+            "status": "error",
+            "code": "quota",
+            "message": "GPT APIの残高が不足している可能性があります。"
+        }
+
+    # その他のエラー
+    return {
+        "status": "error",
+        "code": "other",
+        "message": "ヒントの生成に失敗しました。"
+    }
+
+# ヒントの残り回数が無いときの応答
+NO_HINT_CREDITS = {
+    "status": "error",
+    "code": "no_credits",
+    "message": "今日のヒントを使い切りました。明日また使えるようになります。",
+}
+
+def _hint_request_id():
+    """ブラウザがヒントボタンを押すごとに作る ID。/use_hint/stream と取り直しの /use_hint で同じものが来る。"""
+    return request.form.get('request_id', '')[:64] or None
 
 @app.route('/use_hint', methods=['POST'])
 @login_required
@@ -441,41 +1613,184 @@ def use_hint_route():
     # ここで実際の問題の説明を取得する
     problem_description = problem.description
 
-    try:    
-        if error_type == 'Forbidden':
-            hint_text = get_forbidden_hint(code, error_message)
-        elif error_type in ['Error', 'Wrong Answer']:
-            wrong_answer_info = f"Error Details: {error_message}"
-            hint_text = get_wrong_answer(code, problem_description, "", "", wrong_answer_info)
-        else:
-            hint_text = get_ai_hint(code, problem_description, "", "", error_message)
+    kind, error_key, generate, _ = _hint_generators(code, problem_description, error_type, error_message)
+    request_id = _hint_request_id()
+    # GPT を呼ぶ前にヒント1回分を消費しておく（同時に押されても残り回数を超えない）
+    source = consume_hint_credit(current_user.id, kind, problem.id, request_id)
+    if source is None:
+        return jsonify(NO_HINT_CREDITS)
+    db.session.commit()
 
+    try:
+        hint_text = cached_hint(kind, problem.id, code, error_key, generate)
         return jsonify({"status": "success", "hint": hint_text})
 
     except Exception as e:
-        error_msg = str(e)
-        app.logger.error("Hint generation failed: %s", error_msg)
-
-        # 💡 quota or 残高不足っぽい文言なら「quota」コードを返す
-        if "quota" in error_msg or "insufficient" in error_msg or "billing" in error_msg:
-            return jsonify({
-                "status": "error",
-                "code": "quota",
-                "message": "GPT APIの残高が不足している可能性があります。"
-            })
-
-        # その他のエラー
-        return jsonify({
-            "status": "error",
-            "code": "other",
-            "message": "ヒントの生成に失敗しました。"
-        })
+        db.session.rollback()
+        refund_hint_credit(current_user.id, source, kind, problem.id, request_id)
+        db.session.commit()
+        return jsonify(_hint_error(e))
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/use_hint/stream', methods=['POST'])
+@login_required
+def use_hint_stream_route():
+    """
+    /use_hint のストリーミング版（Server-Sent Events）。
+    GPT から届いた断片を token イベントでそのまま送り、最後に done を送る。
+    ブラウザが切断したらジェネレータが閉じられ、GPT への接続もそこで閉じる（ヒント1回分は返す）。
+    """
+    problem_id = request.form.get('problem_id')
+    code = request.form.get('code')
+    error_type = request.form.get('error_type', '')
+    error_message = request.form.get('error_message', '')
+    problem = db.session.get(Problem, problem_id)
+    if not problem:
+        return jsonify({"status": "failed", "message": "問題が見つかりません。"}), 404
+    problem_id = problem.id
+
+    kind, error_key, _, stream = _hint_generators(code, problem.description, error_type, error_message)
+    key = hint_cache_key(kind, problem_id, code, error_key)
+    user_id = current_user.id
+    request_id = _hint_request_id()
+    source = consume_hint_credit(user_id, kind, problem_id, request_id)
+    if source is None:
+        return Response(_sse("error", NO_HINT_CREDITS), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+    db.session.commit()
+    cached = lookup_hint(key)
+
+    def refund(e):
+        db.session.rollback()
+        refund_hint_credit(user_id, source, kind, problem_id, request_id)
+        db.session.commit()
+        return _sse("error", _hint_error(e))
+
+    def events():
+        if cached is not None:
+            yield _sse("token", cached)
+            yield _sse("done", {})
+            return
+        # 同じキーのヒントを作っている最中なら GPT は呼ばず、出来上がったものを1回で送る
+        while True:
+            call, leader = hint_flight.begin(key)
+            if leader:
+                break
+            try:
+                hint = hint_flight.wait(call)
+            except HintAborted:
+                continue  # 作っていた側のブラウザが切断したので、作り直す
+            except Exception as e:
+                yield refund(e)
+                return
+            yield _sse("token", hint)
+            yield _sse("done", {})
+            return
+        try:
+            hint = lookup_hint(key)  # 直前に別の要求が作り終えていた
+            if hint is not None:
+                yield _sse("token", hint)
+            else:
+                pieces = []
+                tokens = stream()
+                try:
+                    for piece in tokens:
+                        pieces.append(piece)
+                        yield _sse("token", piece)
+                finally:
+                    tokens.close()
+                # 最後まで届いたヒントだけをキャッシュする
+                hint = "".join(pieces)
+                store_hint(key, kind, problem_id, hint)
+        except GeneratorExit:
+            # ブラウザが切断した。GPT への接続は閉じたので途中までのヒントは残らず、キャッシュもしない。
+            # 最後まで届けられなかった分として回数を返す（取り直しの /use_hint は同じ request_id で1回だけ消費する）
+            hint_flight.end(key, call, error=HintAborted())
+            db.session.rollback()
+            refund_hint_credit(user_id, source, kind, problem_id, request_id)
+            db.session.commit()
+            raise
+        except BaseException as e:
+            # 待っている要求は必ず起こす
+            hint_flight.end(key, call, error=e)
+            if not isinstance(e, Exception):
+                raise
+            yield refund(e)
+            return
+        hint_flight.end(key, call, hint)
+        yield _sse("done", {})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 提出履歴の1ページあたりの件数
+SUBMISSIONS_PAGE_SIZE = 50
+
+def encode_cursor(submission_time, submission_id):
+    raw = f"{submission_time.isoformat()}|{submission_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """カーソルを (submission_time, id) に戻す。壊れていれば None。"""
+    try:
+        submission_time, submission_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(submission_time), int(submission_id)
+    except (ValueError, UnicodeError):
+        return None
+
+def submission_page_query(user_id, after=None):
+    """
+    提出履歴を (submission_time, id) の新しい順に返すクエリ。after より古いものだけを返す（キーセット方式）。
+    一覧に要らない列は読み込まない（ヒントの先頭は with_hint_previews で別に引く）。
+    """
+    query = db.session.query(Submission).options(
+        load_only(Submission.id, Submission.problem_id, Submission.submission_time, Submission.status,
+                  Submission.max_wall_time, Submission.peak_memory_kb, Submission.hint_hash)
+    ).filter(Submission.user_id == user_id)
+    if after is not None:
+        query = query.filter(tuple_(Submission.submission_time, Submission.id) < after)
+    return query.order_by(Submission.submission_time.desc(), Submission.id.desc())
+
+def with_hint_previews(submissions, length=60):
+    """提出の一覧を (提出, ヒントの先頭) のリストにする。ヒント文は種類が少ないので、まとめて1回で読む。"""
+    hints = load_texts(sub.hint_hash for sub in submissions if sub.hint_hash)
+    return [(sub, hints.get(sub.hint_hash, "")[:length]) for sub in submissions]
 
 @app.route('/submissions')
 @login_required
 def submissions():
-    submissions = Submission.query.filter_by(user_id=current_user.id).order_by(Submission.submission_time.desc()).all()
-    return render_template('submissions.html', submissions=submissions)
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            abort(400)
+    rows = submission_page_query(current_user.id, after).limit(SUBMISSIONS_PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(rows) > SUBMISSIONS_PAGE_SIZE:
+        rows = rows[:SUBMISSIONS_PAGE_SIZE]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.submission_time, last.id)
+    rows = with_hint_previews(rows)
+
+    if _wants_json():
+        # 無限スクロール用の軽い JSON
+        return jsonify({
+            "items": [{
+                "id": sub.id,
+                "problem_id": sub.problem_id,
+                "submission_time": sub.submission_time.strftime('%Y-%m-%d %H:%M:%S'),
+                "status": sub.status,
+                "max_wall_time": sub.max_wall_time,
+                "peak_memory_kb": sub.peak_memory_kb,
+                "hint_preview": hint_preview or "",
+                "detail_url": url_for('submission_detail', submission_id=sub.id),
+            } for sub, hint_preview in rows],
+            "next_cursor": next_cursor,
+        })
+    return render_template('submissions.html', submissions=rows, next_cursor=next_cursor)
 
 @app.route('/submission/<int:submission_id>')
 @login_required
@@ -486,41 +1801,210 @@ def submission_detail(submission_id):
         abort(403)
     return render_template('submission_detail.html', submission=submission)
 
-def can_use_hint(user):
-    # ユーザーの無料ヒント利用状況を日付でリセットする処理
+# 1日あたりの無料ヒント回数
+FREE_HINTS_PER_DAY = 3
+
+def _hint_day_is_stale(table, now):
+    # 最後にリセットしてから日付（UTC）が変わっている
+    return or_(table.c.last_hint_reset.is_(None), func.date(table.c.last_hint_reset) < now.date().isoformat())
+
+def _hint_request_paid(user_id, request_id):
+    # request_id のヒント要求が消費したまま（返していない）か。UPDATE の条件に入れて使う
+    net = (
+        db.select(func.coalesce(func.sum(HintLedger.delta), 0))
+        .where(HintLedger.user_id == user_id, HintLedger.request_id == request_id)
+        .scalar_subquery()
+    )
+    return net < 0
+
+def consume_hint_credit(user_id, kind=None, problem_id=None, request_id=None):
+    """
+    ヒント1回分を消費し、HintLedger に記録する（コミットは呼び出し側で行う）。
+    日付が変わっていれば無料枠を戻してから使い、無料枠が無ければ購入分を使う。
+    残りの確認・リセット・消費を1つの条件付き UPDATE で行うので、同時に来ても使いすぎない。
+    free_hints_used はその日に使った回数（購入分を含む）で、FREE_HINTS_PER_DAY を超えた分が購入分。
+    request_id を渡すと、同じ ID で消費済みのとき（ストリームが途中で切れて /use_hint で取り直すときなど）は
+    もう一度は消費せず、そのときの source を返す。この確認も同じ UPDATE の条件で行う。
+    使えたら "free" か "purchased" を、残っていなければ None を返す。
+    """
     now = datetime.now(timezone.utc)
-    if user.last_hint_reset.date() < now.date():
-        user.reset_free_hints()
-        db.session.commit()
-    
-    total_available = (3 - user.free_hints_used) + user.purchased_hints
-    return total_available > 0
+    table = User.__table__
+    stale = _hint_day_is_stale(table, now)
+    used = func.coalesce(table.c.free_hints_used, 0)
+    purchased = func.coalesce(table.c.purchased_hints, 0)
+    has_free = or_(stale, used < FREE_HINTS_PER_DAY)
+    conditions = [table.c.id == user_id, or_(has_free, purchased > 0)]
+    if request_id:
+        conditions.append(~_hint_request_paid(user_id, request_id))
+    stmt = (
+        update(table)
+        .where(*conditions)
+        .values(
+            free_hints_used=case((stale, 1), else_=used + 1),
+            purchased_hints=case((has_free, purchased), else_=purchased - 1),
+            last_hint_reset=case((stale, now), else_=table.c.last_hint_reset),
+        )
+        .returning(table.c.free_hints_used)
+    )
+    row = db.session.execute(stmt).first()
+    if row is None:
+        # UPDATE で書き込みロックを取った後なので、ここで読む台帳はほかのリクエストと食い違わない
+        if request_id and db.session.scalar(db.select(_hint_request_paid(user_id, request_id))):
+            return db.session.query(HintLedger.source).filter_by(
+                user_id=user_id, request_id=request_id, reason="hint").order_by(HintLedger.id.desc()).limit(1).scalar()
+        return None
+    source = "free" if row.free_hints_used <= FREE_HINTS_PER_DAY else "purchased"
+    db.session.add(HintLedger(user_id=user_id, delta=-1, source=source, reason="hint", kind=kind,
+                              problem_id=problem_id, request_id=request_id or None))
+    return source
 
-def use_hint(user):
+def refund_hint_credit(user_id, source, kind=None, problem_id=None, request_id=None):
     """
-    ユーザーがヒントを利用する場合の処理。
-    利用可能なら、無料ヒントが残っていればそれを使い、
-    なくなっている場合は購入済みヒントを消費する。
-    利用可能なヒントがなければFalseを返す。
+    consume_hint_credit で使った1回分を返す（ヒントの生成に失敗したとき。コミットは呼び出し側で行う）。
+    日付が変わって無料枠がリセット済みなら、無料分は返さなくてよい。
+    request_id を渡すと、その ID の消費がまだ返していないときだけ返す（二重に返さない）。
     """
     now = datetime.now(timezone.utc)
-    if user.last_hint_reset.date() < now.date():
-        user.reset_free_hints()
-        db.session.commit()
+    table = User.__table__
+    same_day = ~_hint_day_is_stale(table, now)
+    conditions = [table.c.id == user_id]
+    if request_id:
+        conditions.append(_hint_request_paid(user_id, request_id))
+    refunded = db.session.execute(
+        update(table)
+        .where(*conditions)
+        .values(
+            free_hints_used=case((and_(same_day, table.c.free_hints_used > 0), table.c.free_hints_used - 1),
+                                 else_=table.c.free_hints_used),
+            purchased_hints=func.coalesce(table.c.purchased_hints, 0) + (1 if source == "purchased" else 0),
+        )
+    ).rowcount
+    if refunded:
+        db.session.add(HintLedger(user_id=user_id, delta=1, source=source, reason="refund", kind=kind,
+                                  problem_id=problem_id, request_id=request_id or None))
 
-    # 無料ヒント利用枠
-    free_remaining = 3 - user.free_hints_used
+def can_use_hint(user):
+    """ヒントを使える回数が残っているか（読むだけで、リセットも消費もしない）。"""
+    now = datetime.now(timezone.utc)
+    used = user.free_hints_used or 0
+    if user.last_hint_reset is None or user.last_hint_reset.date() < now.date():
+        used = 0
+    return max(0, FREE_HINTS_PER_DAY - used) + (user.purchased_hints or 0) > 0
 
-    if free_remaining > 0:
-        user.free_hints_used += 1
-        db.session.commit()
-        return True
-    elif user.purchased_hints > 0:
-        user.purchased_hints -= 1
-        db.session.commit()
-        return True
-    else:
+def use_hint(user):
+    """
+    ユーザーがヒントを1回使う。無料ヒントが残っていればそれを、なければ購入済みヒントを消費する。
+    利用可能なヒントがなければ False を返す。
+    """
+    if consume_hint_credit(user.id) is None:
         return False
+    db.session.commit()
+    return True
+
+def _hot_queries():
+    """インデックスが効いていてほしい、よく通るクエリ。"""
+    return {
+        "index: solved problems": db.session.query(UserProblemStatus.problem_id).filter_by(user_id=1, best_status="Accepted"),
+        "submissions: history": submission_page_query(1).limit(SUBMISSIONS_PAGE_SIZE + 1),
+        "submissions: next page": submission_page_query(1, (datetime(2025, 1, 1), 100)).limit(SUBMISSIONS_PAGE_SIZE + 1),
+        "problem: test cases": TestCase.query.filter_by(problem_id=1),
+        "login: user by name": User.query.filter_by(username="admin"),
+        "rejudge: submissions of a problem": rejudge_target_query(1, 1000),
+    }
+
+def explain_query_plan(query):
+    """EXPLAIN QUERY PLAN の detail 列を返す。"""
+    sql = str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    """よく通るクエリがテーブル全体の走査や一時 B-tree での並べ替えをしていないか確かめる。"""
+    failed = False
+    for name, query in _hot_queries().items():
+        plan = explain_query_plan(query)
+        bad = [detail for detail in plan
+               if (detail.startswith("SCAN") and "INDEX" not in detail) or "TEMP B-TREE" in detail]
+        failed = failed or bool(bad)
+        print(f"{'NG' if bad else 'OK'}  {name}")
+        for detail in plan:
+            print(f"      {detail}")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command("gc-testdata")
+def gc_testdata():
+    """どのテストケースからも参照されていないテストデータのファイルを消す（書いてから1時間以内のものは残す）。"""
+    referenced = set()
+    for input_hash, output_hash in db.session.query(TestCase.input_hash, TestCase.output_hash):
+        referenced.update(digest for digest in (input_hash, output_hash) if digest)
+    print(f"removed {testdata.collect_garbage(referenced)} files")
+
+def _print_text_storage(stats):
+    mb = 1024 * 1024
+    print(f"submissions: {stats['submissions']}  blobs: {stats['blobs']}")
+    print(f"code+hint: {stats['logical_bytes'] / mb:.1f} MB -> stored {stats['stored_bytes'] / mb:.1f} MB"
+          f" ({stats['saved_ratio'] * 100:.1f}% saved)")
+    print(f"db file: {stats['db_file_bytes'] / mb:.1f} MB (free pages {stats['db_free_bytes'] / mb:.1f} MB)")
+
+@app.cli.command("compact-submissions")
+@click.option("--no-vacuum", is_flag=True, help="VACUUM せず、使われていない本体を消すだけにする")
+def compact_submissions(no_vacuum):
+    """
+    どの提出からも参照されていないコード・ヒントの本体を text_blob から消し、
+    VACUUM で DB ファイルを詰める。VACUUM の間は書き込みが止まり、一時的に DB と同じくらいの空きが要る。
+    """
+    referenced = db.session.query(Submission.code_hash).filter(Submission.code_hash.isnot(None)).union(
+        db.session.query(Submission.hint_hash).filter(Submission.hint_hash.isnot(None)))
+    removed = TextBlob.query.filter(TextBlob.hash.notin_(referenced.scalar_subquery())).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"removed {removed} unreferenced blobs")
+    if not no_vacuum:
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+    _print_text_storage(text_storage_stats())
+
+@app.cli.command("text-stats")
+def text_stats():
+    """提出コード・ヒントの保存量（重複をまとめて圧縮したことでどれだけ減ったか）を表示する。"""
+    _print_text_storage(text_storage_stats())
+
+@app.cli.command("import-pack")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_pack(path):
+    """問題パック（zip）の問題をまとめて登録する。"""
+    try:
+        with open(path, "rb") as f:
+            count = import_problems(packs.read_pack(f))
+    except packs.PackError as e:
+        for error in e.errors:
+            click.echo(error, err=True)
+        raise SystemExit(1)
+    click.echo(f"imported {count} problems")
+
+@app.cli.command("export-pack")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--id", "problem_ids", type=int, multiple=True, help="書き出す問題の ID（省略すると全部）")
+def export_pack(path, problem_ids):
+    """問題をテストデータごと問題パック（zip）に書き出す。"""
+    problems = problems_for_export(problem_ids)
+    with open(path, "wb") as f:
+        for chunk in packs.write_pack(problems, testdata.open_blob):
+            f.write(chunk)
+    click.echo(f"exported {len(problems)} problems")
+
+@app.cli.command("rejudge")
+@click.argument("problem_id", type=int)
+@click.option("--status", "statuses", multiple=True, help="この判定の提出だけを採点し直す（複数指定可）")
+@click.option("--user", "user_id", type=int, help="このユーザーの提出だけを採点し直す")
+def rejudge(problem_id, statuses, user_id):
+    """問題の提出を今のテストケースで採点し直す（このプロセスで最後まで実行する）。"""
+    if db.session.get(Problem, problem_id) is None:
+        raise click.BadParameter(f"problem {problem_id} not found")
+    job_id = _new_rejudge_job(problem_id, statuses, user_id).id
+    _run_rejudge_job(job_id)
+    job = db.session.get(RejudgeJob, job_id)
+    click.echo(f"{job.status}: {job.done}/{job.total} submissions, {job.unique_codes} unique codes, {job.changed} changed")
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
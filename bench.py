@@ -0,0 +1,297 @@
+# bench.py
+"""
+採点と Web の性能を測り、結果を JSON に書き出す。
+OpenAI は呼ばず（PDOJO_HINT_BACKEND=stub）、使い捨てのデータディレクトリに
+本番に近い件数のデータを入れてから測るので、何度実行しても同じ条件になる。
+
+測るもの:
+    sandbox_spawn           何もしないコードを1回実行するまでの時間
+    judge.cases_N           テストケース N 件の提出1つを採点する時間
+    throughput              N 個のクライアントから提出し続けたときの1秒あたりの採点数
+    web.<path>              /, /problems, /submissions, /submit の応答時間
+
+使い方:
+    python bench.py --output bench.json
+    python bench.py --output new.json --compare bench.json   # 基準より遅くなった項目があれば終了コード 1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# 悪化とみなす変化の割合の既定値
+DEFAULT_THRESHOLD = 0.15
+
+ACCEPTED_CODE = "a, b = map(int, input().split())\nprint(a + b)\n"
+
+def _setup_environment(data_dir):
+    # app を import する前に決める必要があるもの
+    os.environ["PDOJO_DATA_DIR"] = data_dir
+    os.environ["PDOJO_HINT_BACKEND"] = "stub"
+    # 測定用のクライアントが受け付け制御で断られないようにする
+    os.environ.setdefault("PDOJO_SUBMIT_BURST", "1000000")
+    os.environ.setdefault("PDOJO_SUBMIT_RATE", "1000000")
+    os.environ.setdefault("PDOJO_JUDGE_MAX_QUEUED", "1000000")
+    os.environ.setdefault("PDOJO_JUDGE_MAX_QUEUED_PER_USER", "1000000")
+
+def summarize(samples):
+    """秒単位の測定値から、ミリ秒の p50/p95/p99/平均を作る。"""
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 3)
+
+    return {
+        "n": len(ordered),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+def _timed(func, repeat, warmup=2):
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+# --- 準備 -------------------------------------------------------------------
+
+def seed(app, users, problems, cases, submissions, rng):
+    """ユーザー・問題・テストケース・提出を入れる。提出は bulk insert でまとめて入れる。"""
+    import migrations
+    import testdata
+    import textblobs
+    from sqlalchemy import insert
+    from app import db, User, Problem, Submission, TextBlob, new_test_case
+
+    with app.app_context():
+        user_rows = []
+        for i in range(users):
+            user = User(username=f"bench{i}")
+            user.set_password("bench")
+            user_rows.append(user)
+        db.session.add_all(user_rows)
+        created = [Problem(title=f"A+B その{i}", description="2つの整数の和を出力してください。\n" * 20)
+                   for i in range(problems)]
+        db.session.add_all(created)
+        db.session.flush()
+        for problem in created:
+            for position in range(cases):
+                a, b = rng.randint(0, 10 ** 6), rng.randint(0, 10 ** 6)
+                db.session.add(new_test_case(problem.id, position, testdata.put_text(f"{a} {b}\n"),
+                                             testdata.put_text(f"{a + b}\n"), is_sample=position == 0))
+        user_ids = [user.id for user in user_rows]
+        problem_ids = [problem.id for problem in created]
+        started = datetime.now(timezone.utc) - timedelta(days=90)
+        rows, blobs = [], {}
+        for i in range(submissions):
+            digest, size, codec, data = textblobs.pack(ACCEPTED_CODE + f"# {i}\n" + "#" * rng.randint(0, 2000))
+            blobs[digest] = {"hash": digest, "size": size, "codec": codec, "data": data}
+            rows.append({
+                "user_id": rng.choice(user_ids),
+                "problem_id": rng.choice(problem_ids),
+                "submission_time": started + timedelta(seconds=i * 300),
+                "status": rng.choice(["Accepted", "Accepted", "Failed"]),
+                "code_hash": digest,
+            })
+        db.session.execute(insert(TextBlob), list(blobs.values()))
+        db.session.execute(insert(Submission), rows)
+        db.session.commit()
+        raw = db.engine.raw_connection()
+        try:
+            migrations._backfill_user_problem_status(raw.driver_connection)
+            raw.commit()
+        finally:
+            raw.close()
+        return user_ids, problem_ids
+
+def _login(app, username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'bench'})
+    return client
+
+# --- 測定 -------------------------------------------------------------------
+
+def bench_sandbox_spawn(repeat):
+    from run_code import run_code
+    return _timed(lambda: run_code("pass\n", ""), repeat)
+
+def bench_judge(case_counts, repeat, rng):
+    from judge import judge_submission
+    results = {}
+    for count in case_counts:
+        cases = []
+        for _ in range(count):
+            a, b = rng.randint(0, 10 ** 6), rng.randint(0, 10 ** 6)
+            cases.append((f"{a} {b}\n", f"{a + b}\n"))
+        results[f"judge.cases_{count}"] = _timed(lambda: judge_submission(ACCEPTED_CODE, "A+B", cases), repeat)
+    return results
+
+def bench_throughput(app, problem_id, clients, duration):
+    """clients 個のスレッドがそれぞれ別のユーザーで提出し続ける。提出ごとにコードを変えてキャッシュを外す。"""
+    counts = [0] * clients
+    errors = [0] * clients
+    stop = time.monotonic() + duration
+
+    def client_loop(index):
+        client = _login(app, f"bench{index}")
+        i = 0
+        while time.monotonic() < stop:
+            code = ACCEPTED_CODE + f"# throughput {index} {i}\n"
+            response = client.post(f'/submit/{problem_id}', data={'code': code})
+            if response.status_code == 200:
+                counts[index] += 1
+            else:
+                errors[index] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {
+        "clients": clients,
+        "duration_s": round(elapsed, 3),
+        "submissions": sum(counts),
+        "errors": sum(errors),
+        "submissions_per_s": round(sum(counts) / elapsed, 3),
+    }
+
+def bench_web(app, problem_id, repeat):
+    client = _login(app, "bench0")
+    counter = iter(range(10 ** 9))
+    requests = {
+        "web./": lambda: client.get('/'),
+        "web./problems": lambda: client.get('/problems'),
+        "web./submissions": lambda: client.get('/submissions'),
+        "web./submit": lambda: client.post(
+            f'/submit/{problem_id}', data={'code': ACCEPTED_CODE + f"# web {next(counter)}\n"}),
+    }
+    results = {}
+    for name, request in requests.items():
+        status = request().status_code
+        if status != 200:
+            raise RuntimeError(f"{name} returned {status}")
+        results[name] = _timed(request, repeat)
+    return results
+
+# --- 比較 -------------------------------------------------------------------
+
+def _metrics(report):
+    """比べる値を (名前, 値, 大きいほど良いか) で並べる。"""
+    for name, result in report["results"].items():
+        if "submissions_per_s" in result:
+            yield f"{name}.submissions_per_s", result["submissions_per_s"], True
+        for key in ("p50_ms", "p95_ms"):
+            if key in result:
+                yield f"{name}.{key}", result[key], False
+
+def compare(baseline, current, threshold):
+    """基準より threshold 以上悪くなった項目の一覧を返し、全項目の比較を表示する。"""
+    base = {name: value for name, value, _ in _metrics(baseline)}
+    regressions = []
+    for name, value, higher_is_better in _metrics(current):
+        if name not in base or not base[name]:
+            continue
+        change = (value - base[name]) / base[name]
+        worse = -change if higher_is_better else change
+        flag = "REGRESSION" if worse > threshold else ""
+        print(f"{name:45s} {base[name]:>12.3f} -> {value:>12.3f}  {change * 100:+7.1f}%  {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+# --- 実行 -------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略すると標準出力）")
+    parser.add_argument("--compare", help="比べる基準の JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="悪化とみなす変化の割合")
+    parser.add_argument("--quick", action="store_true", help="件数を減らして手早く測る")
+    parser.add_argument("--clients", type=int, default=4, help="throughput の同時クライアント数")
+    parser.add_argument("--duration", type=float, default=10.0, help="throughput を測る秒数")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--problems", type=int, default=100)
+    parser.add_argument("--cases", type=int, default=5, help="問題あたりのテストケース数")
+    parser.add_argument("--submissions", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.quick:
+        args.users, args.problems, args.submissions, args.duration = 50, 20, 2000, 3.0
+
+    data_dir = tempfile.mkdtemp(prefix="pdojo-bench-")
+    try:
+        report = _run(args, data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions (threshold {args.threshold * 100:.0f}%)", file=sys.stderr)
+            raise SystemExit(1)
+
+def _run(args, data_dir):
+    repeat = 10 if args.quick else 50
+    _setup_environment(data_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app
+
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+    user_ids, problem_ids = seed(app, args.users, args.problems, args.cases, args.submissions, rng)
+    print(f"seeded in {time.monotonic() - started:.1f}s ({data_dir})", file=sys.stderr)
+
+    results = {"sandbox_spawn": bench_sandbox_spawn(repeat)}
+    results.update(bench_judge([1, 5, 20, 50], max(5, repeat // 5), rng))
+    results["throughput"] = bench_throughput(app, problem_ids[0], min(args.clients, len(user_ids)), args.duration)
+    results.update(bench_web(app, problem_ids[0], repeat))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# caches.py
+import ast
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    スレッドセーフな LRU キャッシュ。maxsize を超えたら古いものから捨てる。
+    ttl（秒）を指定すると、それより古いエントリは無いものとして扱う。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, stored_at = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            return default if item is _MISSING else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """
+    同じキーの処理が同時に呼ばれたら、最初の1回だけを実行し、
+    待っていた呼び出しにも同じ結果（または同じ例外）を返す。
+    プロセス内でのみ有効なので、ワーカーをまたぐ重複は永続キャッシュで吸収する。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key: Hashable) -> Tuple[_Call, bool]:
+        """
+        (呼び出し, 自分が実行するか) を返す。実行する側は必ず end で結果を渡し、
+        待つ側は wait で結果を受け取る（do を1つの関数にできない場合に使う）。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def wait(self, call: _Call) -> Any:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def end(self, key: Hashable, call: _Call, value: Any = None, error: Optional[BaseException] = None):
+        call.value, call.error = value, error
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        call, leader = self.begin(key)
+        if not leader:
+            return self.wait(call)
+        try:
+            value = func()
+        except BaseException as e:
+            self.end(key, call, error=e)
+            raise
+        self.end(key, call, value)
+        return value
+
+def normalize_code(code: str) -> str:
+    """
+    キャッシュのキー用にコードを正規化する。
+    改行コードをそろえ、行末と末尾の空白を取り除く。
+    複数行文字列の中の空白など、意味が変わってしまう場合は改行コードだけそろえる。
+    """
+    code = code.replace("\r\n", "\n").replace("\r", "\n")
+    normalized = "\n".join(line.rstrip() for line in code.split("\n")).rstrip("\n") + "\n"
+    try:
+        if ast.dump(ast.parse(normalized)) != ast.dump(ast.parse(code)):
+            return code
+    except (SyntaxError, ValueError):
+        return code
+    return normalized
+
+def code_hash(code: str) -> str:
+    """正規化したコードの sha256。"""
+    return hashlib.sha256(normalize_code(code).encode("utf-8")).hexdigest()
@@ -0,0 +1,158 @@
+# comparator.py
+import io
+from typing import Union
+
+# 画面に表示する抜粋の長さ（最初の違いの前後それぞれの文字数）
+EXCERPT_CONTEXT = 1000
+
+# 期待する出力を読み進める単位（文字数）
+_READ_SIZE = 65536
+
+class StreamComparator:
+    """
+    ユーザーの出力を少しずつ受け取りながら、期待する出力と比べる。
+    判定は従来の `output.strip() == expected.strip()` と同じ。
+    違いが確定した時点で feed が False を返すので、呼び出し側は実行を打ち切れる。
+    出力と期待する出力は全体を持たず、最初の違いの前後だけを抜粋として残す。
+    """
+
+    def __init__(self, expected: Union[str, io.TextIOBase]):
+        self._expected = io.StringIO(expected) if isinstance(expected, str) else expected
+        self._exp_buf = ""          # 読み込み済みでまだ比べていない期待出力
+        self._exp_started = False   # 期待出力の先頭の空白を読み飛ばしたか
+        self._out_started = False   # 出力の先頭の空白を読み飛ばしたか
+        self._trailing = False      # 以降は両方とも空白だけなら一致、という状態
+        self.mismatch = False
+        # 抜粋
+        self._out_before = ""
+        self._out_after = ""
+        self._exp_before = ""
+        self._exp_after = ""
+        self._out_truncated = False
+        self._exp_truncated = False
+
+    # --- 期待出力の読み出し -------------------------------------------------
+
+    def _fill(self, n):
+        """比較用バッファに期待出力を n 文字以上（終わりまでなら全部）ためる。"""
+        while len(self._exp_buf) < n:
+            chunk = self._expected.read(_READ_SIZE)
+            if not chunk:
+                break
+            if not self._exp_started:
+                stripped = chunk.lstrip()
+                self._remember_expected_skipped(chunk[:len(chunk) - len(stripped)])
+                chunk = stripped
+                if not chunk:
+                    continue
+                self._exp_started = True
+            self._exp_buf += chunk
+
+    def _take_expected(self, n):
+        self._fill(n)
+        taken, self._exp_buf = self._exp_buf[:n], self._exp_buf[n:]
+        return taken
+
+    def _expected_rest_is_blank(self) -> bool:
+        """未比較の期待出力が空白だけか（途中で空白以外が出たら False）。"""
+        while True:
+            if self._exp_buf.strip():
+                return False
+            self._exp_buf = ""
+            self._fill(_READ_SIZE)
+            if not self._exp_buf:
+                return True
+
+    def _remember_expected_skipped(self, text):
+        self._append_before("_exp_before", text, "_exp_truncated")
+
+    # --- 抜粋 ---------------------------------------------------------------
+
+    def _append_before(self, attr, text, truncated_attr):
+        value = getattr(self, attr) + text
+        if len(value) > EXCERPT_CONTEXT:
+            value = value[-EXCERPT_CONTEXT:]
+            setattr(self, truncated_attr, True)
+        setattr(self, attr, value)
+
+    def _append_after(self, attr, text):
+        value = getattr(self, attr)
+        if len(value) < EXCERPT_CONTEXT:
+            setattr(self, attr, value + text[:EXCERPT_CONTEXT - len(value)])
+
+    def _mark_mismatch(self):
+        self.mismatch = True
+        self._fill(EXCERPT_CONTEXT)
+        self._append_after("_exp_after", self._exp_buf)
+
+    # --- 比較 ---------------------------------------------------------------
+
+    def feed(self, chunk: str) -> bool:
+        """出力の続きを受け取る。不一致が確定したら False を返す。"""
+        if self.mismatch:
+            self._append_after("_out_after", chunk)
+            return False
+        if not self._out_started:
+            stripped = chunk.lstrip()
+            self._append_before("_out_before", chunk[:len(chunk) - len(stripped)], "_out_truncated")
+            chunk = stripped
+            if not chunk:
+                return True
+            self._out_started = True
+
+        if self._trailing:
+            # 既に期待出力を読み切っている。空白以外が来たら不一致
+            if chunk.strip():
+                blank = len(chunk) - len(chunk.lstrip())
+                self._append_before("_out_before", chunk[:blank], "_out_truncated")
+                self._out_after = chunk[blank:blank + EXCERPT_CONTEXT]
+                self._mark_mismatch()
+                return False
+            self._append_before("_out_before", chunk, "_out_truncated")
+            return True
+
+        expected = self._take_expected(len(chunk))
+        if expected == chunk:
+            self._append_before("_out_before", chunk, "_out_truncated")
+            self._append_before("_exp_before", expected, "_exp_truncated")
+            return True
+
+        # 最初に食い違う位置
+        diff = 0
+        limit = min(len(chunk), len(expected))
+        while diff < limit and chunk[diff] == expected[diff]:
+            diff += 1
+        self._append_before("_out_before", chunk[:diff], "_out_truncated")
+        self._append_before("_exp_before", expected[:diff], "_exp_truncated")
+        out_rest, exp_rest = chunk[diff:], expected[diff:]
+        self._exp_buf = exp_rest + self._exp_buf
+
+        # 以降が両方とも空白だけなら、末尾の空白の違いにすぎない
+        if not out_rest.strip() and self._expected_rest_is_blank():
+            self._trailing = True
+            self._append_before("_out_before", out_rest, "_out_truncated")
+            return True
+        self._out_after = out_rest[:EXCERPT_CONTEXT]
+        self._mark_mismatch()
+        return False
+
+    def finish(self) -> bool:
+        """出力が終わったところで呼ぶ。一致していれば True。"""
+        if self.mismatch:
+            return False
+        if self._trailing or self._expected_rest_is_blank():
+            return True
+        self._mark_mismatch()
+        return False
+
+    @property
+    def output_excerpt(self) -> str:
+        prefix = "…" if self._out_truncated else ""
+        suffix = "…" if len(self._out_after) >= EXCERPT_CONTEXT else ""
+        return prefix + self._out_before + self._out_after + suffix
+
+    @property
+    def expected_excerpt(self) -> str:
+        prefix = "…" if self._exp_truncated else ""
+        suffix = "…" if self.mismatch and (len(self._exp_after) >= EXCERPT_CONTEXT) else ""
+        return prefix + self._exp_before + self._exp_after + suffix
@@ -1,18 +1,172 @@
 # gpt_hint.py
 import openai
 import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Iterator, List, Optional
 from dotenv import load_dotenv
 
+import metrics
+
 # 必要に応じて load_dotenv() で環境変数を読み込む（.env ファイルがある場合）
 load_dotenv()
 
-# 既に環境変数から API キーを読み込む場合は、この行は不要
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# "openai"（既定）または "stub"。stub ならネットワークに出ず決まった文面を返す（オフラインでの確認用）
+HINT_BACKEND = os.getenv("PDOJO_HINT_BACKEND", "openai")
 
-def get_ai_hint(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> str:
+class StubClient:
     """
-    ユーザーのコード、問題文、入力例、出力例、エラー内容を元に、AI にヒントを出してもらう関数
+    openai と同じ形（client.chat.completions.create）で呼べる、オフライン用のクライアント。
+    delay 秒待ってから固定の文面を返し、呼ばれた回数を calls に数える。
+    stream=True なら文面を少しずつ返す。
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        content = f"（スタブのヒント #{self.calls}）入力の読み取り方と出力の形式をもう一度確かめてみましょう。"
+        usage = SimpleNamespace(
+            prompt_tokens=sum(estimate_tokens(message["content"]) for message in messages),
+            completion_tokens=estimate_tokens(content),
+        )
+        if stream:
+            return self._stream(content, usage)
+        if self.delay:
+            time.sleep(self.delay)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def _stream(self, content, usage):
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        for piece in pieces:
+            if self.delay:
+                time.sleep(self.delay / len(pieces))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+        # 本物の API と同じく、最後に使用量だけのチャンクを返す
+        yield SimpleNamespace(choices=[], usage=usage)
+
+# 1回の呼び出しのタイムアウト（秒）と、429/5xx・接続エラー時の再試行回数
+HINT_TIMEOUT = float(os.getenv("PDOJO_HINT_TIMEOUT", "15"))
+HINT_RETRIES = int(os.getenv("PDOJO_HINT_RETRIES", "2"))
+# 1プロセスで同時に GPT を呼ぶ数の上限。埋まっていたら待たずに HintBusy を送出する
+HINT_MAX_INFLIGHT = int(os.getenv("PDOJO_HINT_MAX_INFLIGHT", "4"))
+# プロンプトに埋め込むユーザーコード・問題文などの合計トークン数（概算）の上限
+HINT_PROMPT_TOKENS = int(os.getenv("PDOJO_HINT_PROMPT_TOKENS", "1500"))
+
+_RETRY_BASE = 0.5  # 再試行の待ち時間の基準（秒）。attempt ごとに倍にし、その範囲でランダムに待つ
+_RETRY_CAP = 4.0
+
+class HintBusy(Exception):
+    """同時に呼べる数の上限に達していて、ヒントを生成できない。"""
+
+class HintAborted(Exception):
+    """ストリーミングの途中で受け取る側が切断し、ヒントが出来上がらなかった。"""
+
+_state_lock = threading.Lock()
+_state_pid = None
+_client = None
+_inflight = None
+
+def get_client():
+    """
+    ヒント生成に使うクライアントを返す。
+    接続を使い回せるよう1プロセスに1つだけ作る（fork 後は作り直す）。
+    """
+    global _state_pid, _client, _inflight
+    with _state_lock:
+        if _state_pid != os.getpid():
+            if HINT_BACKEND == "stub":
+                _client = StubClient(float(os.getenv("PDOJO_HINT_STUB_DELAY", "0")))
+            else:
+                _client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=HINT_TIMEOUT, max_retries=0)
+            _inflight = threading.BoundedSemaphore(HINT_MAX_INFLIGHT)
+            _state_pid = os.getpid()
+        return _client
+
+# --- 統計 -------------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+def _record(kind, **counts):
+    for name, value in counts.items():
+        if name == "latency":
+            outcome = "error" if counts.get("errors") else "aborted" if counts.get("aborted") else "ok"
+            metrics.observe("pdojo_hint_seconds", value, kind=kind, outcome=outcome)
+        elif name in ("prompt_tokens", "completion_tokens"):
+            metrics.inc("pdojo_hint_tokens_total", value, kind=kind, type=name.split("_")[0])
+        elif name != "calls":
+            metrics.inc("pdojo_hint_events_total", value, kind=kind, event=name)
+    with _stats_lock:
+        stats = _stats.setdefault(kind, {
+            "calls": 0, "errors": 0, "aborted": 0, "rejected": 0, "retries": 0,
+            "latency_total": 0.0, "latency_max": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0,
+        })
+        for name, value in counts.items():
+            if name == "latency":
+                stats["latency_total"] += value
+                stats["latency_max"] = max(stats["latency_max"], value)
+            else:
+                stats[name] += value
+
+def hint_stats() -> dict:
+    """ヒントの種類ごとの呼び出し回数・失敗・途中で切断された数・待たずに断った数・再試行・レイテンシ・トークン使用量。"""
+    with _stats_lock:
+        snapshot = {kind: dict(stats) for kind, stats in _stats.items()}
+    for stats in snapshot.values():
+        stats["latency_avg"] = stats["latency_total"] / stats["calls"] if stats["calls"] else 0.0
+    return snapshot
+
+def _record_usage(kind, usage):
+    if usage is not None:
+        _record(kind, prompt_tokens=usage.prompt_tokens or 0, completion_tokens=usage.completion_tokens or 0)
+
+# --- プロンプトの長さ -------------------------------------------------------
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算。ASCII はおよそ4文字で1トークン、それ以外（日本語など）は1文字1トークンと数える。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def _trim_to_tokens(text: str, budget: int) -> str:
+    """先頭と末尾を残し、真ん中を省いて budget トークン程度に収める。"""
+    if estimate_tokens(text) <= budget:
+        return text
+    marker = "\n…（長いため省略）…\n"
+    # 1文字あたりのトークン数の平均から残す文字数を見積もる
+    keep = max(0, int(len(text) * budget / estimate_tokens(text)) - len(marker))
+    head = keep * 2 // 3
+    tail = keep - head
+    return text[:head] + marker + (text[-tail:] if tail else "")
+
+def fit_to_budget(*texts: str, budget: Optional[int] = None) -> List[str]:
     """
+    プロンプトに埋め込む複数の文字列を、合計が budget トークン程度になるよう切り詰める。
+    短いものはそのまま残し、長いものほど削る（残りの予算を均等に分ける）。
+    """
+    budget = HINT_PROMPT_TOKENS if budget is None else budget
+    texts = [text or "" for text in texts]
+    sizes = [estimate_tokens(text) for text in texts]
+    if sum(sizes) <= budget:
+        return texts
+    limits = [0] * len(texts)
+    remaining = budget
+    order = sorted(range(len(texts)), key=lambda i: sizes[i])
+    for n, i in enumerate(order):
+        share = remaining // (len(order) - n)
+        limits[i] = min(sizes[i], share)
+        remaining -= limits[i]
+    return [_trim_to_tokens(text, limit) for text, limit in zip(texts, limits)]
+
+def _ai_hint_messages(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> list:
+    user_code, problem_statement, input_example, output_example, error_message = fit_to_budget(
+        user_code, problem_statement, input_example, output_example, error_message)
     system_prompt = (
         "あなたはプログラミング学習をサポートするAIアシスタントです。"
         "コードの誤りがあっても、直接答えを丸ごと提供せず、"
@@ -38,21 +192,14 @@ def get_ai_hint(user_code: str, problem_statement: str, input_example: str, outp
     {error_message}
     
     【要望】 コードの誤りを直接書かず、考え方や注意点を示唆する形で教えてください。詳しい修正コードは提示せず、ユーザーが自力で修正を思いつけるようアドバイスだけお願いします。"""
-    response = openai.chat.completions.create(
-    model="gpt-3.5-turbo",
-    messages=[
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
-    ],
-    temperature=0.7,
-    max_tokens=300,
-    )
-    return response.choices[0].message.content
+    ]
 
-def get_wrong_answer(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> str:
-    """
-    ユーザーのコードや問題文などを元に、AIに警告アンサー（注意点を示す）を出してもらう関数
-    """
+def _wrong_answer_messages(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> list:
+    user_code, problem_statement, input_example, output_example, error_message = fit_to_budget(
+        user_code, problem_statement, input_example, output_example, error_message)
     system_prompt = ( 
         "あなたはプログラミング学習をサポートするAIアシスタントです。"
         "コードの誤りを直接修正コードとして提示せず、"
@@ -76,21 +223,13 @@ def get_wrong_answer(user_code: str, problem_statement: str, input_example: str,
     {error_message}
 
     【要望】 コードの誤りを直接修正コードとして提示せず、警告として注意すべき点や考え方を短く示してください。"""
-    response = openai.chat.completions.create(
-    model="gpt-3.5-turbo",
-    messages=[
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
-    ],
-    temperature=0.7,
-    max_tokens=300,
-    )
-    return response.choices[0].message.content
+    ]
 
-def get_forbidden_hint(user_code: str, forbidden_op: str) -> str:
-    """
-    禁止された操作 (forbidden_op) をユーザーコード内で検出したとき、 なぜ禁止されているのか・どんなリスクがあるのか・代替手段は何かを GPT に説明してもらうための関数。
-    """
+def _forbidden_hint_messages(user_code: str, forbidden_op: str) -> list:
+    user_code, forbidden_op = fit_to_budget(user_code, forbidden_op)
     system_prompt = (
         "あなたはプログラミング学習をサポートするAIアシスタントです。"
         "禁止されている操作を使おうとしているユーザーに、セキュリティや学習上の理由を簡潔に示唆し、"
@@ -105,13 +244,112 @@ def get_forbidden_hint(user_code: str, forbidden_op: str) -> str:
     {user_code}
     【要望】 なぜこの操作が禁止されているのか、どのようなリスクがあるのか、 また代わりにどのようなアプローチがあるかを、短いヒントとして教えてください。 修正コードは直接書かずに、考え方や注意点を示唆する形でお願いします。 """
 
-    response = openai.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.7,
-        max_tokens=300,
-    )
-    return response.choices[0].message.content
\ No newline at end of file
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+def _create(kind: str, **kwargs):
+    """chat.completions.create を呼ぶ。429/5xx・接続エラーはランダムに間をあけて再試行する。"""
+    client = get_client()
+    for attempt in range(HINT_RETRIES + 1):
+        try:
+            return client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                temperature=0.7,
+                max_tokens=300,
+                **kwargs,
+            )
+        except Exception as e:
+            if attempt == HINT_RETRIES or not _is_retryable(e):
+                raise
+            _record(kind, retries=1)
+            time.sleep(random.uniform(0, min(_RETRY_CAP, _RETRY_BASE * 2 ** attempt)))
+
+def _acquire(kind: str):
+    get_client()
+    if not _inflight.acquire(blocking=False):
+        _record(kind, rejected=1)
+        raise HintBusy("hint backend is saturated")
+    return _inflight
+
+def _complete(kind: str, messages: list) -> str:
+    slot = _acquire(kind)
+    started = time.monotonic()
+    try:
+        response = _create(kind, messages=messages)
+    except Exception:
+        _record(kind, calls=1, errors=1, latency=time.monotonic() - started)
+        raise
+    finally:
+        slot.release()
+    _record(kind, calls=1, latency=time.monotonic() - started)
+    _record_usage(kind, getattr(response, "usage", None))
+    return response.choices[0].message.content
+
+def _stream(kind: str, messages: list) -> Iterator[str]:
+    """
+    届いた順に文字列の断片を返すジェネレータ。
+    途中で close() されたら（ブラウザが切断したときなど）上流の接続もすぐ閉じ、aborted として数える。
+    同時実行数の枠はストリームを読み終わるまで持ち続ける。
+    """
+    slot = _acquire(kind)
+    started = time.monotonic()
+    response = None
+    failed = aborted = False
+    try:
+        response = _create(kind, messages=messages, stream=True, stream_options={"include_usage": True})
+        for chunk in response:
+            _record_usage(kind, getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content
+            if piece:
+                yield piece
+    except GeneratorExit:
+        aborted = True
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        slot.release()
+        _record(kind, calls=1, errors=int(failed), aborted=int(aborted), latency=time.monotonic() - started)
+        close = getattr(response, "close", None)
+        if close:
+            close()
+
+def get_ai_hint(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> str:
+    """
+    ユーザーのコード、問題文、入力例、出力例、エラー内容を元に、AI にヒントを出してもらう関数
+    """
+    return _complete("general", _ai_hint_messages(user_code, problem_statement, input_example, output_example, error_message))
+
+def get_wrong_answer(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> str:
+    """
+    ユーザーのコードや問題文などを元に、AIに警告アンサー（注意点を示す）を出してもらう関数
+    """
+    return _complete("wrong_answer", _wrong_answer_messages(user_code, problem_statement, input_example, output_example, error_message))
+
+def get_forbidden_hint(user_code: str, forbidden_op: str) -> str:
+    """
+    禁止された操作 (forbidden_op) をユーザーコード内で検出したとき、 なぜ禁止されているのか・どんなリスクがあるのか・代替手段は何かを GPT に説明してもらうための関数。
+    """
+    return _complete("forbidden", _forbidden_hint_messages(user_code, forbidden_op))
+
+def stream_ai_hint(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> Iterator[str]:
+    """get_ai_hint のストリーミング版。"""
+    return _stream("general", _ai_hint_messages(user_code, problem_statement, input_example, output_example, error_message))
+
+def stream_wrong_answer(user_code: str, problem_statement: str, input_example: str, output_example: str, error_message: str = "") -> Iterator[str]:
+    """get_wrong_answer のストリーミング版。"""
+    return _stream("wrong_answer", _wrong_answer_messages(user_code, problem_statement, input_example, output_example, error_message))
+
+def stream_forbidden_hint(user_code: str, forbidden_op: str) -> Iterator[str]:
+    """get_forbidden_hint のストリーミング版。"""
+    return _stream("forbidden", _forbidden_hint_messages(user_code, forbidden_op))
@@ -0,0 +1,335 @@
+# judge.py
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, as_completed
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from run_code import (
+    extract_relevant_error, check_forbidden_operations, compile_submission, submit_cases, Cancellation,
+    TIME_LIMIT_EXCEEDED, MEMORY_LIMIT_EXCEEDED, OUTPUT_LIMIT_EXCEEDED,
+)
+from comparator import EXCERPT_CONTEXT
+
+logger = logging.getLogger(__name__)
+
+# 1プロセスあたりの採点ワーカースレッド数
+JUDGE_WORKERS = int(os.environ.get("PDOJO_JUDGE_WORKERS", "2"))
+
+# 待ち時間・処理時間の統計に使う直近のジョブ数
+STATS_SAMPLES = 200
+
+LIMIT_VERDICTS = (TIME_LIMIT_EXCEEDED, MEMORY_LIMIT_EXCEEDED, OUTPUT_LIMIT_EXCEEDED)
+
+# 結果画面に出す入力・期待する出力の最大文字数
+PREVIEW_LIMIT = 2 * EXCERPT_CONTEXT
+
+def _preview(data) -> str:
+    """
+    結果画面とヒント用に、入力や期待する出力の先頭だけを返す。
+    テストデータのファイル（os.PathLike）なら先頭だけを読む。
+    """
+    if data is None:
+        return ""
+    if isinstance(data, os.PathLike):
+        with open(data, encoding="utf-8", errors="replace") as f:
+            data = f.read(PREVIEW_LIMIT + 1)
+    return data[:PREVIEW_LIMIT] + "…" if len(data) > PREVIEW_LIMIT else data
+
+def _evaluate_case(input_data, expected_output, run) -> dict:
+    """1つのテストケースの実行結果（RunResult）から判定結果の辞書を作る。"""
+    result = {
+        "input": _preview(input_data),
+        # 出力は比較しながら読んでいるので、最初の違いの前後だけが残っている
+        "expected": run.expected_excerpt if run.expected_excerpt is not None else _preview(expected_output),
+        "output": run.stdout,
+        "error": "",
+        "status": "Accepted",
+        "wall_time": round(run.wall_time, 3),
+        "cpu_time": round(run.cpu_time, 3),
+        "memory_kb": run.memory_kb
+    }
+    # スタックトレースからユーザーコード関連部分だけを抽出
+    short_stderr = extract_relevant_error(run.stderr)
+
+    if run.verdict:
+        # 時間・メモリ・出力サイズの制限超過
+        result["status"] = run.verdict
+        result["error"] = short_stderr or run.verdict
+    elif short_stderr:
+        result["status"] = "Error"
+        result["error"] = short_stderr
+    elif not run.matched:
+        result["status"] = "Wrong Answer"
+    return result
+
+def _skipped_case(input_data, expected_output) -> dict:
+    """fail-fast で打ち切ったテストケースの判定結果。"""
+    return {
+        "input": _preview(input_data),
+        "expected": _preview(expected_output),
+        "output": "",
+        "error": "",
+        "status": "Skipped"
+    }
+
+def _hint_for_failure(result, user_code, problem_description):
+    """最初に失敗したテストケースから (hint_prompt, hint_params) を作る。"""
+    if result["status"] in LIMIT_VERDICTS:
+        return "実行時間・メモリ・出力の制限を超えました。ヒントをもらいますか？", {
+            "error_type": result["status"],
+            "error_message": result["error"],
+            "user_code": user_code,
+            "problem_description": problem_description,
+            "input_example": result["input"],
+            "output_example": result["expected"]
+        }
+    if result["status"] == "Error":
+        return "エラーが発生しました。ヒントをもらいますか？", {
+            "error_type": "Error",
+            "error_message": result["error"],
+            "user_code": user_code,
+            "problem_description": problem_description,
+            "input_example": result["input"],
+            "output_example": result["expected"]
+        }
+    return "不正解でした。ヒントをもらいますか？", {
+        "error_type": "Wrong Answer",
+        "error_message": f"Expected: {result['expected'].strip()}\nGot: {result['output'].strip()}",
+        "user_code": user_code,
+        "problem_description": problem_description,
+        "input_example": result["input"],
+        "output_example": result["expected"]
+    }
+
+def judge_submission(
+    user_code: str,
+    problem_description: str,
+    test_cases: List[Tuple[str, str]],
+    on_result: Optional[Callable[[int, dict], None]] = None,
+    fail_fast: bool = False,
+    background: bool = False,
+) -> dict:
+    """
+    提出コードを採点する。test_cases は (input_data, expected_output) のリスト。
+    それぞれ文字列か、テストデータのファイルのパス（os.PathLike）。
+    テストケースが終わるたびに on_result(index, result) を呼ぶ（終わった順）。
+    fail_fast が真なら最初の失敗で残りのテストケースを打ち切り、"Skipped" とする。
+    background が真なら、通常の提出のためにサンドボックスの枠を残して実行する（再採点用。submit_cases を参照）。
+    戻り値は results（テストケース順）, overall, hint_prompt, hint_params を持つ辞書。
+    """
+    hint_prompt = None  # ヒント取得を促すメッセージ
+    hint_params = {}  # ヒント生成に使うパラメータ
+
+    # 静的チェックを実行
+    forbidden = check_forbidden_operations(user_code)
+    if forbidden:
+        error_type, message = forbidden
+        result = {
+            "input": "",
+            "expected": "",
+            "output": "",
+            "error": message,
+            "status": error_type  # Forbidden Command, File Operation, or Exit Function
+        }
+        if on_result:
+            on_result(0, result)
+        return {
+            "results": [result],
+            "overall": "Failed",
+            "hint_prompt": "禁止操作が検出されました。ヒントをもらいますか？",
+            "hint_params": {
+                "error_type": error_type,
+                "error_message": message,
+                "user_code": user_code,
+                "problem_description": problem_description
+            },
+            **resource_usage([result]),
+        }
+
+    # テストケースを動かす前に1回だけコンパイルし、構文エラーはここで報告する
+    compiled, syntax_error = compile_submission(user_code)
+    if syntax_error:
+        result = {
+            "input": "",
+            "expected": "",
+            "output": "",
+            "error": extract_relevant_error(syntax_error),
+            "status": "Error"
+        }
+        if on_result:
+            on_result(0, result)
+        hint_prompt, hint_params = _hint_for_failure(result, user_code, problem_description)
+        return {
+            "results": [result],
+            "overall": "Failed",
+            "hint_prompt": hint_prompt,
+            "hint_params": hint_params,
+            **resource_usage([result]),
+        }
+
+    # 各テストケースを並列に実行し、終わったものから判定する
+    cancel = Cancellation() if fail_fast else None
+    futures = submit_cases(
+        user_code,
+        [input_data for input_data, _ in test_cases],
+        cancel,
+        compiled,
+        expected_outputs=[
+            expected_output if isinstance(expected_output, os.PathLike) else expected_output or ""
+            for _, expected_output in test_cases
+        ],
+        background=background,
+    )
+    index_of = {future: i for i, future in enumerate(futures)}
+    results = [None] * len(futures)
+    for future in as_completed(futures):
+        i = index_of[future]
+        input_data, expected_output = test_cases[i]
+        try:
+            run = future.result()
+        except CancelledError:
+            results[i] = _skipped_case(input_data, expected_output)
+        else:
+            results[i] = _evaluate_case(input_data, expected_output, run)
+            if cancel and results[i]["status"] != "Accepted" and not cancel.cancelled:
+                # 実行待ちのものは取り消し、実行中のサンドボックスは kill する
+                cancel.cancel()
+                for other in futures:
+                    other.cancel()
+        if on_result:
+            on_result(i, results[i])
+
+    # ヒントはテストケース順で最初に失敗したものから作る
+    for result in results:
+        if result["status"] not in ("Accepted", "Skipped"):
+            hint_prompt, hint_params = _hint_for_failure(result, user_code, problem_description)
+            break
+
+    all_passed = all(result["status"] == "Accepted" for result in results)
+    return {
+        "results": results,
+        "overall": "Accepted" if all_passed else "Failed",
+        "hint_prompt": hint_prompt,
+        "hint_params": hint_params,
+        **resource_usage(results),
+    }
+
+def resource_usage(results) -> dict:
+    """テストケースごとの測定値から、提出全体の最大値をまとめる。"""
+    measured = [result for result in results if "wall_time" in result]
+    if not measured:
+        return {"max_wall_time": None, "max_cpu_time": None, "peak_memory_kb": None}
+    return {
+        "max_wall_time": max(result["wall_time"] for result in measured),
+        "max_cpu_time": max(result["cpu_time"] for result in measured),
+        "peak_memory_kb": max(result["memory_kb"] for result in measured),
+    }
+
+class JudgeQueue:
+    """
+    採点ジョブをためておき、ワーカースレッドで処理するプロセス内キュー。
+    外部のブローカーは使わない。
+    ジョブはキー（ユーザーなど）ごとに並べ、キーを順番に回して1件ずつ取り出す。
+    1人が続けて何件も積んでも、ほかの人のジョブはその後ろに並ばない。
+    同時に処理するジョブ数はワーカースレッド数で頭打ちになる。
+    """
+
+    def __init__(self, workers: int = JUDGE_WORKERS):
+        self.workers = workers
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._waiting = OrderedDict()  # キー -> deque[(func, args, future, 積んだ時刻)]
+        self._depth = 0
+        self._running = 0
+        self._waits = deque(maxlen=STATS_SAMPLES)  # 待ち時間（秒）
+        self._durations = deque(maxlen=STATS_SAMPLES)  # 処理時間（秒）
+
+    def _ensure_started(self):
+        # fork 後の gunicorn ワーカーでは自分のスレッドを起動し直す
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._reset()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"judge-queue-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _next_job(self):
+        with self._cond:
+            while not self._waiting:
+                self._cond.wait()
+            # 先頭のキーから1件取り、まだ残っていればそのキーを末尾に回す（ラウンドロビン）
+            key, jobs = next(iter(self._waiting.items()))
+            job = jobs.popleft()
+            del self._waiting[key]
+            if jobs:
+                self._waiting[key] = jobs
+            self._depth -= 1
+            self._running += 1
+            self._waits.append(time.monotonic() - job[3])
+            return job
+
+    def _worker(self):
+        while True:
+            func, args, future, _ = self._next_job()
+            started = time.monotonic()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args))
+                    except Exception as e:
+                        logger.exception("Judge job failed")
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._durations.append(time.monotonic() - started)
+
+    def submit(self, func: Callable, *args, key: Hashable = None) -> Future:
+        """
+        ジョブをキューに積む。func(*args) がワーカースレッドで実行される。
+        key ごとに順番に処理する。戻り値の Future で結果を待てる。
+        """
+        self._ensure_started()
+        future = Future()
+        with self._cond:
+            self._waiting.setdefault(key, deque()).append((func, args, future, time.monotonic()))
+            self._depth += 1
+            self._cond.notify()
+        return future
+
+    def depth(self, key: Hashable = None) -> int:
+        """処理待ちのジョブ数。key を渡すとそのキーの分だけ。"""
+        with self._cond:
+            if key is None:
+                return self._depth
+            jobs = self._waiting.get(key)
+            return len(jobs) if jobs else 0
+
+    def stats(self) -> dict:
+        """待ち行列の長さと、最近のジョブの待ち時間・処理時間（秒）。"""
+        with self._cond:
+            waits = sorted(self._waits)
+            durations = list(self._durations)
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._depth,
+                "queued_keys": len(self._waiting),
+                "wait_p50": _percentile(waits, 0.5),
+                "wait_p95": _percentile(waits, 0.95),
+                "wait_max": waits[-1] if waits else None,
+                "duration_avg": sum(durations) / len(durations) if durations else None,
+            }
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q))]
@@ -0,0 +1,279 @@
+# metrics.py
+"""
+カウンター・ヒストグラム・ゲージを集めて、Prometheus のテキスト形式で返す。
+
+gunicorn の各ワーカーは自分の値を PDOJO_METRICS_DIR に JSON で書き出しておき（数秒ごと）、
+/metrics を受けたワーカーが全員分を足し合わせて返す。どのワーカーに当たっても同じ合計になる。
+終了したワーカーのカウンター・ヒストグラムは archived.json にまとめて残す（合計が減らないように）。
+ゲージはその時点の値なので、動いているワーカーの分だけを足す。
+"""
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+METRICS_DIR = os.environ.get("PDOJO_METRICS_DIR", os.path.join(tempfile.gettempdir(), "pdojo-metrics"))
+# 各ワーカーが値を書き出す間隔（秒）
+FLUSH_INTERVAL = float(os.environ.get("PDOJO_METRICS_FLUSH_INTERVAL", "5"))
+
+# レイテンシ用の既定のバケット（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_ARCHIVE = "archived.json"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # 名前 -> (種類, 説明, バケット)
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], list] = {}  # [バケットごとの件数..., +Inf の件数, 合計]
+        self._gauges: Dict[str, Callable] = {}
+        self._pid = None
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = (kind, help_text, tuple(buckets) if kind == "histogram" else None)
+
+    def gauge(self, name, help_text, func: Callable):
+        """
+        ゲージを登録する。func は書き出すたびに呼ばれ、数値か {ラベルの dict を表すタプル: 数値} を返す。
+        """
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = func
+
+    # --- 記録 ---------------------------------------------------------------
+
+    def inc(self, name, value=1.0, **labels):
+        self._ensure_flusher()
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name, value, **labels):
+        self._ensure_flusher()
+        buckets = self._meta[name][2]
+        key = (name, _labels(labels))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # --- 書き出し -----------------------------------------------------------
+
+    def _ensure_flusher(self):
+        # fork 後のワーカーでは、親から引き継いだ値を捨てて自分の書き出しスレッドを起動する
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._counters.clear()
+            self._histograms.clear()
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def _gauge_values(self):
+        values = []
+        for name, func in self._gauges.items():
+            try:
+                result = func()
+            except Exception:
+                continue
+            if isinstance(result, dict):
+                values.extend([name, list(labels), value] for labels, value in result.items())
+            elif result is not None:
+                values.append([name, [], result])
+        return values
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(counts)] for (name, labels), counts in self._histograms.items()]
+        return {
+            "pid": os.getpid(),
+            "updated": time.time(),
+            "counters": counters,
+            "histograms": histograms,
+            "gauges": self._gauge_values(),
+        }
+
+    def flush(self):
+        """このプロセスの値をファイルに書き出す（一時ファイルから置き換えるので、読む側は壊れた途中を見ない）。"""
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+
+    # --- 集計 ---------------------------------------------------------------
+
+    def collect(self) -> dict:
+        """全ワーカーの値を足し合わせる。"""
+        self._ensure_flusher()
+        self.flush()
+        counters, histograms, gauges = {}, {}, {}
+        with _locked_dir():
+            dead = []
+            for name in os.listdir(METRICS_DIR):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(METRICS_DIR, name)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                alive = name == _ARCHIVE or _is_alive(data["pid"])
+                _merge(data, counters, histograms)
+                if alive and name != _ARCHIVE and time.time() - data["updated"] < FLUSH_INTERVAL * 3:
+                    for gauge, labels, value in data["gauges"]:
+                        key = (gauge, tuple(map(tuple, labels)))
+                        gauges[key] = gauges.get(key, 0) + value
+                if not alive:
+                    dead.append(path)
+            if dead:
+                _archive(dead)
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式（version 0.0.4）。"""
+        collected = self.collect()
+        lines = []
+        by_name = {}
+        for kind in ("counters", "histograms", "gauges"):
+            for (name, labels), value in collected[kind].items():
+                by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            kind, help_text, buckets = self._meta.get(name, ("untyped", "", None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name]):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                if buckets is None or len(value) != len(buckets) + 2:
+                    continue  # バケットを変えた直後の古いファイル
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), value):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def _is_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _merge(data, counters, histograms):
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, counts in data["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        current = histograms.get(key)
+        if current is None:
+            histograms[key] = list(counts)
+        elif len(current) == len(counts):
+            histograms[key] = [a + b for a, b in zip(current, counts)]
+
+@contextmanager
+def _locked_dir():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _archive(paths):
+    """終了したワーカーのファイルを archived.json に足し込んで消す（_locked_dir の中で呼ぶ）。"""
+    counters, histograms = {}, {}
+    archive_path = os.path.join(METRICS_DIR, _ARCHIVE)
+    for path in [archive_path] + paths:
+        try:
+            with open(path) as f:
+                _merge(json.load(f), counters, histograms)
+        except (OSError, ValueError):
+            continue
+    data = {
+        "pid": 0,
+        "updated": time.time(),
+        "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+        "histograms": [[name, list(labels), counts] for (name, labels), counts in histograms.items()],
+        "gauges": [],
+    }
+    fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, archive_path)
+    for path in paths:
+        os.unlink(path)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def _format_value(value) -> str:
+    return repr(float(value))
+
+registry = Registry()
+describe = registry.describe
+gauge = registry.gauge
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+render = registry.render
+
+# --- 測る項目 ---------------------------------------------------------------
+
+describe("pdojo_http_request_seconds", "histogram", "Flask のリクエスト処理時間（エンドポイント・ステータス別）")
+describe("pdojo_db_commit_seconds", "histogram", "SQLAlchemy セッションのコミットにかかった時間（エンドポイント別）")
+describe("pdojo_db_rollbacks_total", "counter", "ロールバックの回数（エンドポイント別）")
+describe("pdojo_template_render_seconds", "histogram", "テンプレートの描画時間（テンプレート別）")
+describe("pdojo_sandbox_wait_seconds", "histogram", "サンドボックスの空き枠を待った時間")
+describe("pdojo_sandbox_acquire_seconds", "histogram", "ワーカーインタプリタを用意する時間（待機中のものが無ければ起動を含む）")
+describe("pdojo_sandbox_run_seconds", "histogram", "ユーザーコードの実行時間（判定別）")
+describe("pdojo_hint_seconds", "histogram", "ヒント生成（OpenAI 呼び出し）の時間（種類・成否別）")
+describe("pdojo_hint_events_total", "counter", "ヒント生成の失敗・待たずに断った数・再試行の回数（種類・イベント別）")
+describe("pdojo_hint_tokens_total", "counter", "ヒント生成で使ったトークン数（種類・prompt/completion 別）")
@@ -0,0 +1,171 @@
+# migrations.py
+"""
+SQLite のスキーママイグレーション。
+適用済みのバージョンは PRAGMA user_version に記録し、足りない分だけを順に適用する。
+db.create_all() で作ったばかりの DB にも適用されるので、各マイグレーションは
+「既にあれば何もしない」ように書く。
+"""
+
+import testdata
+import textblobs
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def _add_column(conn, table, column, ddl):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def _submission_resource_usage(conn):
+    # 提出ごとの最大実行時間・CPU 時間・最大メモリ
+    _add_column(conn, "submission", "max_wall_time", "FLOAT")
+    _add_column(conn, "submission", "max_cpu_time", "FLOAT")
+    _add_column(conn, "submission", "peak_memory_kb", "INTEGER")
+
+def _create_index(conn, name, table, columns, unique=False):
+    conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+def _hot_path_indexes(conn):
+    # app.py のモデルの Index と同じ名前・同じ列にする
+    _create_index(conn, "ix_submission_user_status_problem", "submission", ["user_id", "status", "problem_id"])
+    _create_index(conn, "ix_submission_user_time", "submission", ["user_id", "submission_time", "id"])
+    _create_index(conn, "ix_test_case_problem_id", "test_case", ["problem_id"])
+
+def _backfill_user_problem_status(conn):
+    # それまでの提出から、ユーザーごと・問題ごとの成績をまとめて作る
+    conn.execute("""
+        INSERT OR IGNORE INTO user_problem_status
+            (user_id, problem_id, best_status, attempts, first_accepted_at, last_submitted_at)
+        SELECT s.user_id, s.problem_id,
+               CASE WHEN MAX(s.status = 'Accepted') THEN 'Accepted' ELSE (
+                   SELECT l.status FROM submission l
+                   WHERE l.user_id = s.user_id AND l.problem_id = s.problem_id AND l.status != 'Judging'
+                   ORDER BY l.submission_time DESC, l.id DESC LIMIT 1
+               ) END,
+               COUNT(*),
+               MIN(CASE WHEN s.status = 'Accepted' THEN s.submission_time END),
+               MAX(s.submission_time)
+        FROM submission s
+        WHERE s.status IS NOT NULL AND s.status != 'Judging'
+        GROUP BY s.user_id, s.problem_id
+    """)
+
+def _version_stamp_updated_at(conn):
+    # キャッシュのバージョンを最後に進めた日時
+    _add_column(conn, "version_stamp", "updated_at", "DATETIME")
+
+def _test_data_out_of_row(conn):
+    # テストデータの本体を testdata のファイルに移し、DB にはハッシュとサイズだけを残す
+    _add_column(conn, "test_case", "position", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "test_case", "is_sample", "BOOLEAN NOT NULL DEFAULT 0")
+    _add_column(conn, "test_case", "input_hash", "VARCHAR(64)")
+    _add_column(conn, "test_case", "input_size", "INTEGER")
+    _add_column(conn, "test_case", "output_hash", "VARCHAR(64)")
+    _add_column(conn, "test_case", "output_size", "INTEGER")
+    rows = conn.execute(
+        "SELECT id, input_data, expected_output FROM test_case WHERE input_hash IS NULL ORDER BY problem_id, id"
+    ).fetchall()
+    for test_id, input_data, expected_output in rows:
+        input_hash, input_size = testdata.put_text(input_data or "")
+        output_hash, output_size = testdata.put_text(expected_output or "")
+        # それまでは全テストケースを問題ページに出していたので、サンプル扱いにしておく
+        conn.execute(
+            "UPDATE test_case SET input_hash = ?, input_size = ?, output_hash = ?, output_size = ?,"
+            " position = id, is_sample = 1, input_data = NULL, expected_output = NULL WHERE id = ?",
+            (input_hash, input_size, output_hash, output_size, test_id),
+        )
+
+def _rejudge_index(conn):
+    # 再採点で問題ごとの提出を id 順に読む
+    _create_index(conn, "ix_submission_problem", "submission", ["problem_id", "id"])
+
+def _put_text_blob(conn, body):
+    digest, size, codec, data = textblobs.pack(body)
+    conn.execute("INSERT OR IGNORE INTO text_blob (hash, size, codec, data) VALUES (?, ?, ?, ?)",
+                 (digest, size, codec, data))
+    return digest
+
+def _submission_text_out_of_row(conn):
+    # 提出のコード・ヒントの本体を text_blob に移し（同じ内容は1行にまとめて圧縮）、提出には sha256 だけを残す。
+    # 空いたページは VACUUM（flask compact-submissions）するまでファイルの大きさとしては残る
+    _add_column(conn, "submission", "code_hash", "VARCHAR(64)")
+    _add_column(conn, "submission", "hint_hash", "VARCHAR(64)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS text_blob ("
+        " hash VARCHAR(64) NOT NULL PRIMARY KEY, size INTEGER NOT NULL, codec VARCHAR(10) NOT NULL, data BLOB NOT NULL)"
+    )
+    last_id = 0
+    while True:
+        # 全件をメモリに載せないよう、ID 順に少しずつ移す
+        rows = conn.execute(
+            "SELECT id, code, hint FROM submission WHERE id > ? AND code_hash IS NULL ORDER BY id LIMIT 1000",
+            (last_id,),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for submission_id, code, hint in rows:
+            # ヒントの無い提出は hint_hash を NULL にする
+            updates.append((_put_text_blob(conn, code or ""), _put_text_blob(conn, hint) if hint else None, submission_id))
+        conn.executemany("UPDATE submission SET code_hash = ?, hint_hash = ?, code = NULL, hint = NULL WHERE id = ?",
+                         updates)
+        last_id = rows[-1][0]
+
+def _hint_ledger_request_id(conn):
+    # ヒント要求ごとの ID（ストリームが切れて取り直したときに二重に消費しないため）
+    _add_column(conn, "hint_ledger", "request_id", "VARCHAR(64)")
+    _create_index(conn, "ix_hint_ledger_request", "hint_ledger", ["user_id", "request_id"])
+
+def _verdict_cache_last_used(conn):
+    # 採点結果キャッシュを古い順・使われていない順に消すための列と索引
+    _add_column(conn, "verdict_cache_entry", "last_used_at", "DATETIME")
+    conn.execute("UPDATE verdict_cache_entry SET last_used_at = created_at WHERE last_used_at IS NULL")
+    _create_index(conn, "ix_verdict_cache_entry_created_at", "verdict_cache_entry", ["created_at"])
+    _create_index(conn, "ix_verdict_cache_entry_last_used_at", "verdict_cache_entry", ["last_used_at"])
+
+def _admission_reservation_started(conn):
+    # 採点中の予約も残して、全ワーカーの採点中の数を数えられるようにする（テーブルは admission.metadata で作る）
+    _add_column(conn, "admission_reservation", "started", "FLOAT")
+
+# 追加するときは末尾に足す（順番がそのままバージョン番号になる）
+MIGRATIONS = [
+    _submission_resource_usage,
+    _hot_path_indexes,
+    _backfill_user_problem_status,
+    _version_stamp_updated_at,
+    _test_data_out_of_row,
+    _rejudge_index,
+    _submission_text_out_of_row,
+    _hint_ledger_request_id,
+    _verdict_cache_last_used,
+    _admission_reservation_started,
+]
+
+def upgrade(engine):
+    """
+    未適用のマイグレーションを1つのトランザクションで適用する。
+    BEGIN IMMEDIATE で書き込みロックを取るので、複数の gunicorn ワーカーが
+    同時に起動しても二重に適用されない。適用後のバージョンを返す。
+    """
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None  # トランザクションを自分で管理する
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for migration in MIGRATIONS[version:]:
+                    migration(conn)
+                version = max(version, len(MIGRATIONS))
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = isolation_level
+        return version
+    finally:
+        raw.close()
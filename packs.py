@@ -0,0 +1,182 @@
+# packs.py
+"""
+問題パック（複数の問題をまとめた zip）の読み書き。
+
+zip の中身:
+    manifest.json
+        {"format": 1,
+         "problems": [
+             {"title": "...", "description": "...",
+              "cases": [{"input": "hello/1.in", "output": "hello/1.out", "sample": true}, ...]},
+             ...]}
+    manifest から参照するテストデータのファイル（名前と置き場所は自由）
+
+テストデータは zip から少しずつ展開して testdata に保存するので、大きなパックもメモリに載せない。
+DB に書くのは呼び出し側（app.py）の役目で、ここでは検証とファイルの出し入れだけをする。
+"""
+import json
+import os
+import zipfile
+from typing import BinaryIO, Callable, Iterable, Iterator, List
+
+import testdata
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+# 展開後のテストデータの合計の上限（zip 爆弾よけ）
+MAX_UNPACKED_BYTES = int(os.environ.get("PDOJO_PACK_MAX_MB", "4096")) * 1024 * 1024
+
+# タイトルの最大長（Problem.title と合わせる）
+TITLE_MAX = 200
+
+_COPY_CHUNK = 1 << 20
+
+class PackError(ValueError):
+    """パックの形式が正しくない。errors に見つかった問題をすべて持つ。"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+def _validate(manifest, members) -> List[str]:
+    """manifest の中身を確かめ、問題点のリストを返す（無ければ空）。"""
+    if not isinstance(manifest, dict) or manifest.get("format") != FORMAT_VERSION:
+        return [f"{MANIFEST} の format は {FORMAT_VERSION} である必要があります"]
+    problems = manifest.get("problems")
+    if not isinstance(problems, list) or not problems:
+        return [f"{MANIFEST} に problems がありません"]
+    errors = []
+    for i, problem in enumerate(problems, 1):
+        where = f"problems[{i}]"
+        if not isinstance(problem, dict):
+            errors.append(f"{where}: オブジェクトではありません")
+            continue
+        title = problem.get("title")
+        if not isinstance(title, str) or not title.strip():
+            errors.append(f"{where}: title がありません")
+        elif len(title) > TITLE_MAX:
+            errors.append(f"{where}: title が {TITLE_MAX} 文字を超えています")
+        if not isinstance(problem.get("description"), str) or not problem["description"].strip():
+            errors.append(f"{where}: description がありません")
+        cases = problem.get("cases")
+        if not isinstance(cases, list) or not cases:
+            errors.append(f"{where}: cases がありません")
+            continue
+        for j, case in enumerate(cases, 1):
+            if not isinstance(case, dict):
+                errors.append(f"{where}.cases[{j}]: オブジェクトではありません")
+                continue
+            for key in ("input", "output"):
+                name = case.get(key)
+                if name is None and key == "input":
+                    continue  # 入力の無い問題もある
+                if not isinstance(name, str) or name not in members:
+                    errors.append(f"{where}.cases[{j}]: {key} のファイル {name!r} が zip にありません")
+    return errors
+
+def read_pack(source: BinaryIO) -> List[dict]:
+    """
+    パックを検証し、テストデータを testdata に保存する。
+    戻り値は {"title", "description", "cases": [{"input": (sha256, size), "output": (sha256, size), "sample"}]} のリスト。
+    形式に問題があれば何も保存せずに PackError を投げる。
+    source はシークできるファイル（アップロードされた一時ファイルなど）。
+    """
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipFile:
+        raise PackError(["zip ファイルではありません"])
+    with archive:
+        members = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+        if MANIFEST not in members:
+            raise PackError([f"{MANIFEST} がありません"])
+        try:
+            manifest = json.loads(archive.read(MANIFEST).decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise PackError([f"{MANIFEST} を読めません: {e}"])
+        errors = _validate(manifest, members)
+        if errors:
+            raise PackError(errors)
+        referenced = {case[key] for problem in manifest["problems"] for case in problem["cases"]
+                      for key in ("input", "output") if case.get(key)}
+        if sum(members[name].file_size for name in referenced) > MAX_UNPACKED_BYTES:
+            raise PackError([f"テストデータが大きすぎます（上限 {MAX_UNPACKED_BYTES // (1024 * 1024)} MB）"])
+
+        # 同じファイルを複数のテストケースから参照していても、展開は1回だけ
+        stored = {}
+        empty = testdata.put_text("")
+        for name in referenced:
+            with archive.open(name) as member:
+                stored[name] = testdata.put_stream(member)
+
+    return [
+        {
+            "title": problem["title"].strip(),
+            "description": problem["description"],
+            "cases": [
+                {
+                    "input": stored[case["input"]] if case.get("input") else empty,
+                    "output": stored[case["output"]],
+                    "sample": bool(case.get("sample", False)),
+                }
+                for case in problem["cases"]
+            ],
+        }
+        for problem in manifest["problems"]
+    ]
+
+class _ChunkWriter:
+    """zipfile の書き込み先。書かれたバイト列をためておき、take で取り出す。"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def write_pack(problems: Iterable[dict], open_data: Callable[[str], BinaryIO]) -> Iterator[bytes]:
+    """
+    問題パックの zip を少しずつ生成する。レスポンスにそのまま流せる。
+    problems は {"id", "title", "description", "cases": [{"input": sha256, "output": sha256, "sample"}]} の並び。
+    テストデータは open_data(sha256) で開いて読み、同じ内容は zip に1回だけ入れる。
+    """
+    out = _ChunkWriter()
+    manifest = {"format": FORMAT_VERSION, "problems": []}
+    written = set()
+    # シークできない書き込み先なので、zipfile はデータ記述子つきで書く
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for problem in problems:
+            cases = []
+            for case in problem["cases"]:
+                names = {}
+                for key in ("input", "output"):
+                    digest = case[key]
+                    name = f"data/{digest[:2]}/{digest}"
+                    names[key] = name
+                    if name in written:
+                        continue
+                    written.add(name)
+                    with open_data(digest) as src, archive.open(name, "w", force_zip64=True) as dst:
+                        while True:
+                            chunk = src.read(_COPY_CHUNK)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            data = out.take()
+                            if data:
+                                yield data
+                cases.append({"input": names["input"], "output": names["output"], "sample": case["sample"]})
+            manifest["problems"].append(
+                {"title": problem["title"], "description": problem["description"], "cases": cases}
+            )
+        archive.writestr(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=1))
+    yield out.take()
@@ -1,10 +1,107 @@
 # run_code.py
+import io
 import os
+import ast
+import hashlib
+import sys
+import time
+import codecs
+import queue
+import signal
+import selectors
 import subprocess
 import tempfile
-import py_compile
+import threading
+import marshal
+import traceback
 import re
-from typing import Optional, Tuple
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from caches import LRUCache
+from comparator import StreamComparator
+import metrics
+
+# 実行タイムアウト（秒）
+RUN_TIMEOUT = 5
+
+# ワーカーにかける資源制限（CPU 時間・アドレス空間・出力サイズ）
+CPU_TIME_LIMIT = int(os.environ.get("PDOJO_CPU_TIME_LIMIT", str(RUN_TIMEOUT)))  # 秒
+MEMORY_LIMIT = int(os.environ.get("PDOJO_MEMORY_LIMIT_MB", "256")) * 1024 * 1024  # バイト
+# 出力のバイト数の上限。期待する出力が分かっている stdout は _stdout_limit で広げる
+OUTPUT_LIMIT = int(os.environ.get("PDOJO_OUTPUT_LIMIT_KB", "8192")) * 1024
+# ファイルから stdin に流すときの1回の読み込みサイズ
+_STDIN_CHUNK = 65536
+STDERR_KEEP = 64 * 1024  # stderr は末尾（トレースバック）だけを残す
+
+TIME_LIMIT_EXCEEDED = "Time Limit Exceeded"
+MEMORY_LIMIT_EXCEEDED = "Memory Limit Exceeded"
+OUTPUT_LIMIT_EXCEEDED = "Output Limit Exceeded"
+
+# 待機させておくワーカーインタプリタの数（0 なら事前起動せず都度起動）
+POOL_SIZE = int(os.environ.get("PDOJO_POOL_SIZE", "2"))
+
+# プロセス全体で同時に動かすサンドボックス数の上限（既定はコア数）
+MAX_SANDBOXES = int(os.environ.get("PDOJO_MAX_SANDBOXES", os.cpu_count() or 1))
+# そのうち再採点などの後回しにできる採点（background=True）が同時に使える数。
+# 残りの枠は通常の提出のために空けておく（MAX_SANDBOXES が 1 なら 1 枠を交互に使う）
+BACKGROUND_SANDBOXES = int(os.environ.get("PDOJO_BACKGROUND_SANDBOXES", str(max(1, MAX_SANDBOXES // 2))))
+
+# トレースバック上でユーザーコードとして表示するファイル名。
+# extract_relevant_error のパターン（tmp を含む .tmp ファイル）に合わせている。
+USER_CODE_FILENAME = os.path.join(tempfile.gettempdir(), "user_code.tmp")
+
+# ワーカー側で動くブートストラップ。
+# よく使われるモジュールを先に import して待機し、stdin から
+# 「8バイトの長さ + marshal した (ソース, コードオブジェクト)」を受け取ったら
+# 資源制限をかけ、残りの stdin を入力として実行する。コンパイルは親プロセスで提出ごとに1回だけ行う。
+# ヘッダは os.read で読むので、sys.stdin のバッファには入力データだけが残る。
+_WORKER_BOOTSTRAP = """
+import os, sys, builtins, linecache, marshal, resource, signal, traceback
+import math, itertools, collections, heapq, bisect, functools, re, string
+
+def _read_exact(n):
+    buf = b""
+    while len(buf) < n:
+        chunk = os.read(0, n - len(buf))
+        if not chunk:
+            sys.exit(0)
+        buf += chunk
+    return buf
+
+_size = int.from_bytes(_read_exact(8), "big")
+_source, _code = marshal.loads(_read_exact(_size))
+_filename = sys.argv[1]
+_cpu, _memory, _output, _stats_fd = (int(v) for v in sys.argv[2:6])
+
+def _report_peak_memory():
+    # fork 元の分が混ざる ru_maxrss ではなく、exec 後の最大常駐メモリ（VmHWM）を親に伝える
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    os.write(_stats_fd, line.split()[1].encode())
+                    break
+    except Exception:
+        pass
+
+def _on_cpu_limit(signum, frame):
+    _report_peak_memory()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+signal.signal(signal.SIGXCPU, _on_cpu_limit)
+resource.setrlimit(resource.RLIMIT_CPU, (_cpu, _cpu + 1))
+resource.setrlimit(resource.RLIMIT_AS, (_memory, _memory))
+resource.setrlimit(resource.RLIMIT_FSIZE, (_output, _output))
+linecache.cache[_filename] = (len(_source), None, _source.splitlines(True), _filename)
+sys.argv = [_filename]
+sys.excepthook = traceback.print_exception  # linecache 経由でソース行も表示する
+try:
+    exec(_code, {"__name__": "__main__", "__file__": _filename, "__builtins__": builtins})
+finally:
+    _report_peak_memory()
+"""
 
 def extract_relevant_error(stderr):
     """
@@ -22,60 +119,585 @@ def extract_relevant_error(stderr):
         relevant_lines = lines
     return "\n".join(relevant_lines)
 
+def compile_submission(user_code) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    ユーザーコードを1回だけコンパイルし、ワーカーに渡せる形（marshal 済み）にする。
+    (コンパイル結果, None) か、構文エラーなら (None, エラーメッセージ) を返す。
+    """
+    try:
+        code = compile(user_code, USER_CODE_FILENAME, "exec", dont_inherit=True)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        return None, "".join(traceback.format_exception_only(type(e), e))
+    return marshal.dumps((user_code, code)), None
+
 def check_syntax(user_code):
     """
     ユーザーコードの構文チェックを行う。
-    一時ファイルの拡張子は .tmp とすることで VS Code の影響を避ける。
     構文エラーがあればエラーメッセージを返し、問題なければ None を返す。
     """
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.tmp', delete=False) as tmp:
-        tmp.write(user_code)
-        tmp_filename = tmp.name
+    return compile_submission(user_code)[1]
 
-    try:
-        py_compile.compile(tmp_filename, doraise=True)
+# 禁止操作のポリシー表。error_type ごとに
+#   names:      参照してはいけない名前（import の別名は元の名前に直してから比べる。"mod.*" はモジュール全体）
+#   attributes: どのオブジェクトに対しても使ってはいけない属性名（サンドボックス脱出の定番）
+#   modules:    import してはいけないモジュール
+#   strings:    文字列定数として書いてはいけない名前（getattr などでの回避を防ぐ）
+FORBIDDEN_POLICY = {
+    "Forbidden Command": {
+        "names": {
+            "eval", "exec", "__import__", "__builtins__", "breakpoint",
+            "os.system", "os.popen", "os.fork", "os.kill", "os.exec*", "os.spawn*", "subprocess.*",
+        },
+        "attributes": {"__subclasses__", "__globals__", "__builtins__", "__code__"},
+        "modules": {"subprocess", "ctypes", "builtins", "importlib", "socket", "multiprocessing"},
+        "strings": {"__builtins__", "__import__", "__subclasses__", "__globals__"},
+    },
+    "File Operation": {
+        "names": {"open", "io.open", "os.open", "os.remove", "os.unlink", "os.rmdir", "os.rename", "shutil.*"},
+        "attributes": set(),
+        "modules": {"shutil"},
+        "strings": set(),
+    },
+    "Exit Function": {
+        "names": {"exit", "quit", "sys.exit", "os._exit", "os.abort"},
+        "attributes": set(),
+        "modules": set(),
+        "strings": set(),
+    },
+}
+
+class _ForbiddenFinder(ast.NodeVisitor):
+    """ソースの順に1回だけ木をたどり、最初に見つかった禁止操作を記録する。"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.aliases = {}  # import で付いた名前 -> 元のモジュール・名前
+        self.found = None
+
+    def _match(self, kind, value):
+        for error_type, rules in self.policy.items():
+            for pattern in rules[kind]:
+                if value == pattern or (pattern.endswith("*") and value.startswith(pattern[:-1])):
+                    return error_type
         return None
-    except py_compile.PyCompileError as e:
-        return str(e)
-    finally:
-        os.remove(tmp_filename)
+
+    def _report(self, kind, value, shown=None):
+        if self.found is None:
+            error_type = self._match(kind, value)
+            if error_type:
+                self.found = (error_type, shown or value)
+
+    def _dotted(self, node):
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None
+        parts.append(self.aliases.get(node.id, node.id))
+        return ".".join(reversed(parts))
+
+    def visit(self, node):
+        if self.found is None:
+            super().visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._report("modules", alias.name.split(".")[0], alias.name)
+            if alias.asname:
+                self.aliases[alias.asname] = alias.name
+            else:
+                top = alias.name.split(".")[0]
+                self.aliases[top] = top
+
+    def visit_ImportFrom(self, node):
+        module = node.module or ""
+        self._report("modules", module.split(".")[0], module)
+        for alias in node.names:
+            if alias.name == "*":
+                # 禁止された名前を含むモジュールからの import * は認めない
+                for rules in self.policy.values():
+                    for pattern in rules["names"]:
+                        if pattern.startswith(module + "."):
+                            self._report("names", pattern, f"from {module} import *")
+                continue
+            full = f"{module}.{alias.name}"
+            self._report("names", full)
+            self.aliases[alias.asname or alias.name] = full
+
+    def visit_Name(self, node):
+        self._report("names", self.aliases.get(node.id, node.id), node.id)
+
+    def visit_Attribute(self, node):
+        self._report("attributes", node.attr)
+        dotted = self._dotted(node)
+        if dotted:
+            self._report("names", dotted)
+        self.generic_visit(node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            self._report("strings", node.value)
+
+# コードのハッシュ -> 判定結果（None も覚えておくので、未判定は別の番兵で表す）
+_forbidden_cache = LRUCache(maxsize=4096)
+_NOT_CHECKED = object()
 
 def check_forbidden_operations(user_code: str) -> Optional[Tuple[str, str]]:
     """
     ユーザーコードに禁止された操作が含まれていないかチェックする。
+    構文木を1回たどり、呼び出し・import・属性アクセスを FORBIDDEN_POLICY と照らし合わせる。
     見つかった場合は (error_type, message) を返し、問題なければ None を返す。
+    結果はコードのハッシュごとに覚えておく。
+    """
+    key = hashlib.sha256(user_code.encode("utf-8")).hexdigest()
+    cached = _forbidden_cache.get(key, _NOT_CHECKED)
+    if cached is not _NOT_CHECKED:
+        return cached
+
+    try:
+        tree = ast.parse(user_code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        # 構文エラーは compile_submission で報告する
+        result = None
+    else:
+        finder = _ForbiddenFinder(FORBIDDEN_POLICY)
+        finder.visit(tree)
+        result = None
+        if finder.found:
+            error_type, pattern = finder.found
+            result = (error_type, f"{error_type} detected: usage of '{pattern}' is not allowed.")
+    _forbidden_cache.set(key, result)
+    return result
+
+class InterpreterPool:
     """
-    forbidden_patterns = {
-        "Forbidden Command": ["os.system", "subprocess.call", "eval", "exec"],
-        "File Operation": ["open("],
-        "Exit Function": ["exit(", "sys.exit("],
-    }
-    
-    for error_type, patterns in forbidden_patterns.items():
-        for pattern in patterns:
-            if pattern in user_code:
-                return error_type, f"{error_type} detected: usage of '{pattern}' is not allowed."
+    起動・import 済みのワーカーインタプリタを待機させておくプール。
+    ワーカーは1回使ったら捨て（隔離のため）、バックグラウンドで補充する。
+    """
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self._idle = queue.Queue()
+        self._wanted = threading.Event()
+        if size > 0:
+            self._wanted.set()
+            threading.Thread(target=self._refill_loop, name="interpreter-pool", daemon=True).start()
+
+    def _spawn(self) -> subprocess.Popen:
+        env = dict(os.environ, PYTHONIOENCODING="utf-8")
+        # 最大メモリ使用量をワーカーから受け取るためのパイプ
+        stats_read, stats_write = os.pipe()
+        try:
+            proc = subprocess.Popen(
+                [sys.executable, "-c", _WORKER_BOOTSTRAP, USER_CODE_FILENAME,
+                 str(CPU_TIME_LIMIT), str(MEMORY_LIMIT), str(OUTPUT_LIMIT), str(stats_write)],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(stats_write,),
+                env=env,
+            )
+        except OSError:
+            os.close(stats_read)
+            raise
+        finally:
+            os.close(stats_write)
+        proc.stats_fd = stats_read
+        return proc
+
+    def _refill_loop(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            while self._idle.qsize() < self.size:
+                try:
+                    self._idle.put(self._spawn())
+                except OSError:
+                    break
+
+    def acquire(self) -> subprocess.Popen:
+        """待機中のワーカーを1つ取り出す。空なら新しく起動する。"""
+        self._wanted.set()
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                return self._spawn()
+            if proc.poll() is None:
+                return proc
+            os.close(proc.stats_fd)
+
+
+_pool = None
+_executor = None
+_background_executor = None
+_sandbox_slots = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# 今ユーザーコードを実行中のサンドボックス数（メトリクス用）
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+def sandboxes_in_flight() -> int:
+    return _in_flight if _pool_pid == os.getpid() else 0
+
+def _ensure_process_state():
+    """
+    プール・スレッドプール・サンドボックス枠をプロセスごとに用意する。
+    gunicorn の fork 後に親のものを引き継がないよう、pid が変わったら作り直す。
+    """
+    global _pool, _executor, _background_executor, _sandbox_slots, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = InterpreterPool()
+            _executor = ThreadPoolExecutor(max_workers=MAX_SANDBOXES * 4, thread_name_prefix="judge")
+            # スレッド数がそのまま後回しの採点の同時実行数になる。待っている分は _executor のスレッドを使わない
+            _background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_SANDBOXES,
+                                                      thread_name_prefix="judge-background")
+            _sandbox_slots = threading.BoundedSemaphore(MAX_SANDBOXES)
+            _pool_pid = os.getpid()
+
+def get_pool() -> InterpreterPool:
+    _ensure_process_state()
+    return _pool
+
+def _decode_output(data: bytes) -> str:
+    # text=True で実行していたときと同じく改行を \n にそろえる
+    return data.decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+class Cancellation:
+    """
+    実行中・実行待ちのテストケースをまとめて打ち切るためのトークン。
+    cancel() すると登録中のワーカーを kill し、以降の run_code は実行せずに CancelledError を投げる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._running = set()
+        self._killed = set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            for proc in self._running:
+                _kill(proc)
+                self._killed.add(proc)
+
+    def _register(self, proc) -> bool:
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._running.add(proc)
+            return True
+
+    def _unregister(self, proc) -> bool:
+        """登録を外し、cancel() で kill されていたら True を返す。"""
+        with self._lock:
+            self._running.discard(proc)
+            return proc in self._killed
+
+class RunResult(NamedTuple):
+    """1回の実行結果と、測定した資源使用量。"""
+    stdout: str
+    stderr: str
+    returncode: int
+    verdict: Optional[str]  # 制限を超えた場合は TIME_LIMIT_EXCEEDED などが入る
+    wall_time: float  # 経過時間（秒）
+    cpu_time: float  # CPU 時間（秒、インタプリタ本体の分も含む）
+    memory_kb: int  # 最大常駐メモリ（KB、測れなかった場合は 0）
+    matched: Optional[bool] = None  # expected_output を渡した場合の比較結果
+    expected_excerpt: Optional[str] = None  # 期待する出力のうち、最初の違いの前後だけ
+
+def _stdin_chunks(header: bytes, input_data) -> Iterator[bytes]:
+    """
+    ワーカーの stdin に書く内容。先頭にコンパイル済みコードを置き、続けて入力を流す。
+    input_data がファイルのパスなら、全体を読み込まずに _STDIN_CHUNK ずつ読みながら渡す。
+    """
+    def chunks():
+        yield header
+        if isinstance(input_data, os.PathLike):
+            with open(input_data, "rb") as f:
+                while True:
+                    chunk = f.read(_STDIN_CHUNK)
+                    if not chunk:
+                        break
+                    yield chunk
+        elif input_data:
+            yield input_data.encode("utf-8")
+    return chunks()
+
+def _stdout_limit(expected_size: Optional[int]) -> int:
+    """
+    stdout のバイト数の上限。期待する出力が大きいテストケースでも正解を Output Limit Exceeded にしないよう、
+    その2倍（改行を \r\n で出しても収まる）まで許す。OUTPUT_LIMIT より小さくはしない。
+    """
+    if expected_size is None:
+        return OUTPUT_LIMIT
+    return max(OUTPUT_LIMIT, 2 * expected_size)
+
+def _communicate(proc, payload, deadline, on_stdout=None, stdout_limit=OUTPUT_LIMIT):
+    """
+    stdin に payload（_stdin_chunks で作ったもの）を書き込みながら stdout / stderr を少しずつ読む。
+    時間切れか出力サイズ超過（stdout は stdout_limit、stderr は OUTPUT_LIMIT）ならワーカーを kill する。
+    on_stdout を渡すと stdout は溜めずに読んだ分ずつ渡し、False が返ったら kill する。
+    (stdout, stderr, 打ち切り理由, 最大常駐メモリ KB) を返す。
+    """
+    stopped = False
+    stdout_chunks, stderr_tail, stats = [], b"", b""
+    memory_kb = 0
+    output_bytes = {proc.stdout: 0, proc.stderr: 0}
+    reason = None
+    pending = b""
+    # 大きな入力でも1回の select で書けるだけ書けるよう、stdin はノンブロッキングにする
+    os.set_blocking(proc.stdin.fileno(), False)
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdin, selectors.EVENT_WRITE)
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        selector.register(proc.stderr, selectors.EVENT_READ)
+        selector.register(proc.stats_fd, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if reason is not None or stopped:
+                    break  # kill した後もパイプが閉じない
+                reason = TIME_LIMIT_EXCEEDED
+                memory_kb = _sample_peak_memory(proc.pid)
+                _kill(proc)
+                deadline = time.monotonic() + 1
+                continue
+            for key, _ in selector.select(remaining):
+                if key.fileobj is proc.stdin:
+                    if not pending:
+                        pending = next(payload, None)
+                        if pending is None:
+                            selector.unregister(proc.stdin)
+                            proc.stdin.close()
+                            continue
+                    try:
+                        pending = pending[os.write(key.fd, pending):]
+                    except BlockingIOError:
+                        pass
+                    except BrokenPipeError:
+                        # 入力を読み切らずに終了した。残りは捨てる
+                        pending = b""
+                        payload = iter(())
+                    continue
+                data = os.read(key.fd, 32768)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                if key.fileobj is proc.stats_fd:
+                    stats += data
+                    continue
+                if reason is not None or stopped:
+                    continue
+                output_bytes[key.fileobj] += len(data)
+                if key.fileobj is not proc.stdout:
+                    stderr_tail = (stderr_tail + data)[-STDERR_KEEP:]
+                elif on_stdout is None:
+                    stdout_chunks.append(data)
+                elif not on_stdout(data):
+                    # 不正解が確定したので、残りを実行する必要はない
+                    stopped = True
+                    memory_kb = _sample_peak_memory(proc.pid)
+                    _kill(proc)
+                    deadline = time.monotonic() + 1
+                    continue
+                if (output_bytes[proc.stdout] > stdout_limit
+                        or output_bytes[proc.stderr] > OUTPUT_LIMIT):
+                    reason = OUTPUT_LIMIT_EXCEEDED
+                    memory_kb = _sample_peak_memory(proc.pid)
+                    _kill(proc)
+                    deadline = time.monotonic() + 1
+    _close_pipes(proc)
+    if stats.isdigit():
+        memory_kb = max(memory_kb, int(stats))
+    return b"".join(stdout_chunks), stderr_tail, reason, memory_kb
+
+def _close_pipes(proc):
+    """ワーカーの stdin / stdout / stderr を閉じる（何度呼んでもよい）。"""
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        pipe.close()
+
+def _sample_peak_memory(pid) -> int:
+    """kill する直前に、実行中のワーカーの最大常駐メモリ（KB）を読む。"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def _kill(proc):
+    """
+    ワーカーを kill する。Popen.kill は内部で poll() して終了済みの子を回収してしまい、
+    資源使用量が取れなくなるので os.kill を直接使う。
+    """
+    if proc.returncode is None:
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def _reap(proc):
+    """ワーカーの終了を待ち、(returncode, CPU 時間) を返す。"""
+    os.close(proc.stats_fd)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # 既に回収済み（CPU 時間は取れない）
+        return proc.wait(), 0.0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage.ru_utime + usage.ru_stime
+
+def _judge_limits(reason, returncode, stderr, cpu_time):
+    """打ち切り理由や終了状態から、制限超過の判定を返す（超過していなければ None）。"""
+    if reason is not None:
+        return reason
+    if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and cpu_time >= CPU_TIME_LIMIT):
+        return TIME_LIMIT_EXCEEDED
+    last_line = stderr.rstrip().rsplit("\n", 1)[-1]
+    if last_line.startswith("MemoryError"):
+        return MEMORY_LIMIT_EXCEEDED
     return None
 
-def run_code(user_code, input_data):
+def _stdout_feeder(comparator):
+    """stdout のバイト列を文字列に直して comparator に渡すコールバック（_communicate の on_stdout）。"""
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True)
+
+    def feed(data, final=False):
+        return comparator.feed(decoder.decode(data, final=final))
+
+    return feed
+
+def execute(user_code, input_data, cancel: Optional[Cancellation] = None, compiled: Optional[bytes] = None,
+            expected_output: Optional[str] = None) -> RunResult:
     """
-    ユーザーコードを一時ファイル（.tmp）に書き出して実行する。
-    実行結果（stdout, stderr, returncode）を返す。
+    ユーザーコードをプールのワーカーインタプリタに渡し、資源制限付きで実行する。
+    input_data と expected_output は文字列か、テストデータのファイルのパス（os.PathLike）。
+    パスなら中身をメモリに載せず、少しずつ読みながら stdin に流し、出力と比べる。
+    compiled に compile_submission の結果を渡すと、コンパイルをやり直さない。
+    expected_output を渡すと stdout を読みながら比べ、不一致が確定した時点で打ち切る。
+    このとき stdout には最初の違いの前後の抜粋だけが入る。
+    cancel が打ち切られた場合は CancelledError を投げる。
     """
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.tmp', delete=False) as tmp:
-        tmp.write(user_code)
-        tmp_filename = tmp.name
+    if compiled is None:
+        compiled, syntax_error = compile_submission(user_code)
+        if syntax_error:
+            return RunResult("", syntax_error, 1, None, 0.0, 0.0, 0)
+    payload = _stdin_chunks(len(compiled).to_bytes(8, "big") + compiled, input_data)
+
+    comparator, on_stdout, expected_file, expected_size = None, None, None, None
+    if isinstance(expected_output, os.PathLike):
+        # 期待する出力もファイルから少しずつ読んで比べる
+        expected_size = os.path.getsize(expected_output)
+        expected_file = expected_output = open(expected_output, encoding="utf-8", errors="replace")
+    elif expected_output is not None:
+        expected_size = len(expected_output.encode("utf-8"))
+    if expected_output is not None:
+        comparator = StreamComparator(expected_output)
+        on_stdout = _stdout_feeder(comparator)
 
     try:
-        result = subprocess.run(
-            ["python", tmp_filename],
-            input=input_data,
-            capture_output=True,
-            text=True,
-            timeout=5  # タイムアウト 5秒
-        )
-        return result.stdout, result.stderr, result.returncode
-    except subprocess.TimeoutExpired:
-        return "", "Time Limit Exceeded", -1
+        return _execute(payload, cancel, comparator, on_stdout, _stdout_limit(expected_size))
     finally:
-        os.remove(tmp_filename)
+        if expected_file is not None:
+            expected_file.close()
+
+def _execute(payload, cancel, comparator, on_stdout, stdout_limit) -> RunResult:
+    global _in_flight
+    _ensure_process_state()
+    # 空き枠ができるまで待ってから実行する（タイムアウトは実行開始から数える）
+    waited = time.monotonic()
+    with _sandbox_slots:
+        metrics.observe("pdojo_sandbox_wait_seconds", time.monotonic() - waited)
+        if cancel and cancel.cancelled:
+            raise CancelledError()
+        with metrics.timer("pdojo_sandbox_acquire_seconds"):
+            proc = _pool.acquire()
+        if cancel and not cancel._register(proc):
+            _kill(proc)
+            _close_pipes(proc)
+            _reap(proc)
+            raise CancelledError()
+        with _in_flight_lock:
+            _in_flight += 1
+        started = time.monotonic()
+        try:
+            stdout, stderr, reason, memory_kb = _communicate(proc, payload, started + RUN_TIMEOUT, on_stdout,
+                                                             stdout_limit)
+        finally:
+            _kill(proc)
+            _close_pipes(proc)  # _communicate が例外で抜けた場合も閉じる
+            returncode, cpu_time = _reap(proc)
+            with _in_flight_lock:
+                _in_flight -= 1
+        wall_time = time.monotonic() - started
+        if cancel and cancel._unregister(proc):
+            raise CancelledError()
+
+    stderr = _decode_output(stderr)
+    verdict = _judge_limits(reason, returncode, stderr, cpu_time)
+    metrics.observe("pdojo_sandbox_run_seconds", wall_time, verdict=verdict or "ok")
+    if verdict == TIME_LIMIT_EXCEEDED:
+        stderr = TIME_LIMIT_EXCEEDED
+    if comparator is None:
+        return RunResult(_decode_output(stdout), stderr, returncode, verdict, wall_time, cpu_time, memory_kb)
+
+    matched = False
+    if not comparator.mismatch and on_stdout(b"", final=True) and verdict is None:
+        matched = comparator.finish()
+    return RunResult(comparator.output_excerpt, stderr, returncode, verdict, wall_time, cpu_time, memory_kb,
+                     matched, comparator.expected_excerpt)
+
+def _as_triple(result: RunResult) -> Tuple[str, str, int]:
+    # 以前からの (stdout, stderr, returncode) の形にそろえる
+    if result.verdict == TIME_LIMIT_EXCEEDED:
+        return "", TIME_LIMIT_EXCEEDED, -1
+    return result.stdout, result.stderr, result.returncode
+
+def run_code(user_code, input_data, cancel: Optional[Cancellation] = None, compiled: Optional[bytes] = None):
+    """
+    ユーザーコードをプールのワーカーインタプリタに渡して実行する。
+    実行結果（stdout, stderr, returncode）を返す。
+    資源使用量も必要な場合は execute を使う。
+    """
+    return _as_triple(execute(user_code, input_data, cancel, compiled))
+
+def submit_cases(user_code, inputs, cancel: Optional[Cancellation] = None, compiled: Optional[bytes] = None,
+                 expected_outputs=None, background: bool = False) -> List[Future]:
+    """
+    複数のテストケースの実行をスレッドプールに投入し、inputs と同じ順番の Future を返す。
+    コンパイルは全テストケースで1回だけ行う。
+    expected_outputs を渡すと、各テストケースの出力を読みながら比べる（execute を参照）。
+    background が真なら別のスレッドプールで、同時に BACKGROUND_SANDBOXES 個までしか実行しない。
+    各 Future の結果は RunResult。
+    打ち切られたテストケースの Future は CancelledError になる。
+    """
+    _ensure_process_state()
+    if compiled is None:
+        compiled, syntax_error = compile_submission(user_code)
+        if syntax_error:
+            compiled = None  # 構文エラーは各テストケースの execute で同じように報告する
+    if expected_outputs is None:
+        expected_outputs = [None] * len(inputs)
+    executor = _background_executor if background else _executor
+    return [
+        executor.submit(execute, user_code, input_data, cancel, compiled, expected_output)
+        for input_data, expected_output in zip(inputs, expected_outputs)
+    ]
+
+def run_code_many(user_code, inputs) -> List[Tuple[str, str, int]]:
+    """
+    1つの提出に対する複数のテストケースを並列に実行する。
+    結果（stdout, stderr, returncode）は inputs と同じ順番で返す。
+    """
+    return [_as_triple(future.result()) for future in submit_cases(user_code, inputs)]
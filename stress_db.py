@@ -0,0 +1,83 @@
+# stress_db.py
+"""
+/submit と /feedback を複数のプロセスから同時に送り続け、
+"database is locked" などで失敗するリクエストが出ないか確かめる。
+gunicorn の複数ワーカーと同じく、プロセスごとに app を読み込み直す。
+
+使い方:
+    python stress_db.py --workers 8 --requests 30
+失敗が1件でもあれば終了コード 1 で終わる。
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+
+def _worker(index, requests, results):
+    try:
+        results.put(_run_worker(index, requests))
+    except Exception:
+        results.put((0, 1, [], [traceback.format_exc()]))
+
+def _run_worker(index, requests):
+    from app import app
+
+    client = app.test_client()
+    username = f"stress-{os.getpid()}-{index}"
+    client.post('/register', data={'username': username, 'password': 'stress'})
+    client.post('/login', data={'username': username, 'password': 'stress'})
+
+    ok, failed, latencies, errors = 0, 0, [], []
+    for i in range(requests):
+        started = time.monotonic()
+        try:
+            if i % 2:
+                response = client.post('/feedback', data={'target_type': 'problem', 'target_id': '1', 'feedback': 'good'})
+            else:
+                # 採点結果キャッシュに当たらないよう、提出ごとにコードを変える
+                code = f'print("Hello, World!")  # {username} {i}'
+                response = client.post('/submit/1', data={'code': code})
+            if response.status_code >= 500:
+                failed += 1
+                errors.append(f"{response.status_code} {response.get_data(as_text=True)[:200]}")
+            else:
+                ok += 1
+        except Exception:
+            failed += 1
+            errors.append(traceback.format_exc(limit=3))
+        latencies.append(time.monotonic() - started)
+    return ok, failed, latencies, errors[:3]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8, help="同時に動かすプロセス数")
+    parser.add_argument("--requests", type=int, default=30, help="1プロセスあたりのリクエスト数")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    started = time.monotonic()
+    processes = [context.Process(target=_worker, args=(i, args.requests, results)) for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - started
+
+    ok = sum(result[0] for result in collected)
+    failed = sum(result[1] for result in collected)
+    latencies = sorted(latency for result in collected for latency in result[2])
+    print(f"requests: {ok + failed}  ok: {ok}  failed: {failed}  elapsed: {elapsed:.2f}s")
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"latency  p50: {latencies[len(latencies) // 2] * 1000:.0f}ms  p95: {p95 * 1000:.0f}ms  max: {latencies[-1] * 1000:.0f}ms")
+    for result in collected:
+        for error in result[3]:
+            print("---")
+            print(error)
+    raise SystemExit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
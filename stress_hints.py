@@ -0,0 +1,179 @@
+# stress_hints.py
+"""
+同じユーザーで /use_hint を複数のプロセスから同時に送り、
+ヒントの残り回数を超えて使えてしまわないか確かめる。
+GPT はスタブ（PDOJO_HINT_BACKEND=stub）を使い、少し遅らせてリクエストを重ならせる。
+
+使い方:
+    python stress_hints.py --workers 8 --requests 4 --purchased 2
+成功したヒントの数・User の残り回数・HintLedger の記録のどれかが合わなければ終了コード 1 で終わる。
+
+    python stress_hints.py --stream --workers 8
+では同じヒントを /use_hint/stream に1つのプロセスのスレッドから同時に送り、
+GPT（スタブ）の呼び出しが1回にまとまって、全員に同じヒントが届くかを確かめる。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+os.environ.setdefault("PDOJO_HINT_BACKEND", "stub")
+os.environ.setdefault("PDOJO_HINT_STUB_DELAY", "0.05")
+
+def _worker(username, index, requests, start, results):
+    try:
+        results.put(_run_worker(username, index, requests, start))
+    except Exception:
+        results.put((0, 0, [traceback.format_exc()]))
+
+def _run_worker(username, index, requests, start):
+    from app import app
+
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'stress'})
+    start.wait()
+    granted, refused, errors = 0, 0, []
+    for i in range(requests):
+        response = client.post('/use_hint', data={
+            'problem_id': '1',
+            'code': f'print("hint {index} {i}")',
+            'error_type': 'Wrong Answer',
+            'error_message': 'Expected: Hello, World!',
+        })
+        data = response.get_json(silent=True) or {}
+        if data.get("status") == "success":
+            granted += 1
+        elif data.get("code") == "no_credits":
+            refused += 1
+        else:
+            errors.append(f"{response.status_code} {response.get_data(as_text=True)[:200]}")
+    return granted, refused, errors[:3]
+
+def _read_stream(client, data):
+    """SSE の応答を読み切って (届いたヒント, エラーの内容) を返す。"""
+    response = client.post('/use_hint/stream', data=data)
+    hint, error = "", None
+    for block in response.get_data(as_text=True).split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if lines.get("event") == "token":
+            hint += json.loads(lines["data"])
+        elif lines.get("event") == "error":
+            error = lines["data"]
+    return hint, error
+
+def run_stream(args):
+    from app import app, db, User, HintLedger
+    from gpt_hint import get_client
+
+    username = f"hint-stream-{os.getpid()}"
+    with app.app_context():
+        user = User(username=username, purchased_hints=args.workers, free_hints_used=0)
+        user.set_password("stress")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    # 毎回キャッシュに無いヒントにする
+    data = {
+        'problem_id': '1',
+        'code': 'print("hello")',
+        'error_type': 'Wrong Answer',
+        'error_message': f'Expected: Hello, World! ({os.getpid()} {time.time()})',
+    }
+    calls_before = get_client().calls
+    start = threading.Barrier(args.workers)
+    results = [None] * args.workers
+
+    def worker(index):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': 'stress'})
+        start.wait()
+        try:
+            results[index] = _read_stream(client, dict(data, request_id=f"stream-{index}"))
+        except Exception:
+            results[index] = ("", traceback.format_exc())
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    calls = get_client().calls - calls_before
+
+    with app.app_context():
+        ledger = db.session.query(db.func.coalesce(db.func.sum(HintLedger.delta), 0)).filter_by(user_id=user_id).scalar()
+    hints = {hint for hint, _ in results}
+    errors = [error for _, error in results if error]
+    print(f"requests: {args.workers}  upstream calls: {calls}  distinct hints: {len(hints)}  "
+          f"errors: {len(errors)}  ledger total: {ledger}")
+    for error in errors[:3]:
+        print("---")
+        print(error)
+    ok = not errors and calls == 1 and len(hints) == 1 and "" not in hints and -ledger == args.workers
+    print("OK" if ok else "NG: identical hint streams were not coalesced")
+    raise SystemExit(0 if ok else 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8, help="同時に動かすプロセス数")
+    parser.add_argument("--requests", type=int, default=4, help="1プロセスあたりのリクエスト数")
+    parser.add_argument("--purchased", type=int, default=2, help="あらかじめ持たせておく購入済みヒント数")
+    parser.add_argument("--stream", action="store_true", help="/use_hint/stream の同時要求がまとまるかを確かめる")
+    args = parser.parse_args()
+    if args.stream:
+        run_stream(args)
+
+    from app import app, db, User, HintLedger, FREE_HINTS_PER_DAY
+
+    username = f"hint-stress-{os.getpid()}"
+    with app.app_context():
+        user = User(username=username, purchased_hints=args.purchased, free_hints_used=0)
+        user.set_password("stress")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        db.session.remove()
+        db.engine.dispose()  # fork した子に接続を引き継がない
+    allowed = FREE_HINTS_PER_DAY + args.purchased
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    start = context.Event()
+    processes = [context.Process(target=_worker, args=(username, i, args.requests, start, results))
+                 for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    start.set()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    granted = sum(result[0] for result in collected)
+    refused = sum(result[1] for result in collected)
+    errors = [error for result in collected for error in result[2]]
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        ledger = db.session.query(db.func.coalesce(db.func.sum(HintLedger.delta), 0)).filter_by(user_id=user_id).scalar()
+        used, purchased_left = user.free_hints_used, user.purchased_hints
+
+    print(f"requests: {args.workers * args.requests}  granted: {granted}  refused: {refused}  errors: {len(errors)}")
+    print(f"allowed: {allowed}  used today: {used}  purchased left: {purchased_left}  ledger total: {ledger}")
+    for error in errors:
+        print("---")
+        print(error)
+    expected = min(allowed, args.workers * args.requests)
+    ok = (
+        not errors
+        and granted == expected
+        and -ledger == granted
+        and used == granted
+        and purchased_left == args.purchased - max(0, granted - FREE_HINTS_PER_DAY)
+    )
+    print("OK" if ok else "NG: hint credits were over- or under-spent")
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# testdata.py
+"""
+テストデータの置き場所。
+内容の sha256 をファイル名にして /data ボリュームに置き（同じ内容は1つだけ持つ）、
+DB にはハッシュとサイズだけを記録する。大きな入力もメモリに載せずに扱える。
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterable, Tuple
+
+DATA_DIR = os.environ.get("PDOJO_DATA_DIR", "/data")
+STORE_DIR = os.path.join(DATA_DIR, "testdata")
+
+_CHUNK = 1 << 20
+# 書いてからこの秒数が経っていないファイルは、参照されていなくても collect_garbage で消さない
+# （管理画面の編集や問題パックの取り込みで書いた直後、DB にコミットする前のもの）
+GC_GRACE = int(os.environ.get("PDOJO_TESTDATA_GC_GRACE", "3600"))
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+def is_digest(value) -> bool:
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
+
+def blob_path(digest: str) -> Path:
+    """digest のファイルのパス。sha256 の16進表記でなければ（ストアの外を指さないよう）ValueError。"""
+    if not is_digest(digest):
+        raise ValueError(f"invalid test data digest: {digest!r}")
+    return Path(STORE_DIR, digest[:2], digest)
+
+def exists(digest: str) -> bool:
+    return is_digest(digest) and blob_path(digest).is_file()
+
+def _touch(path: Path):
+    """既にあるファイルを使い回すときに更新日時を進め、コミット前に collect_garbage で消されないようにする。"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def put_stream(stream: BinaryIO) -> Tuple[str, int]:
+    """
+    stream を最後まで読んで保存し、(sha256, バイト数) を返す。
+    一時ファイルに書いてから名前を変えるので、途中で失敗しても壊れたファイルは残らない。
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=STORE_DIR, prefix=".incoming-")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        path = blob_path(digest.hexdigest())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            os.unlink(tmp)
+            _touch(path)
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return digest.hexdigest(), size
+
+def put_bytes(data: bytes) -> Tuple[str, int]:
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if path.exists():
+        _touch(path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".incoming-")
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        os.replace(tmp, path)
+    return digest, len(data)
+
+def put_text(text: str) -> Tuple[str, int]:
+    return put_bytes(text.encode("utf-8"))
+
+def open_blob(digest: str) -> BinaryIO:
+    return open(blob_path(digest), "rb")
+
+def read_preview(digest: str, limit: int) -> str:
+    """先頭 limit 文字程度を文字列で返す。続きがあれば末尾に "…" をつける。"""
+    with open(blob_path(digest), encoding="utf-8", errors="replace") as f:
+        text = f.read(limit + 1)
+    return text[:limit] + "…" if len(text) > limit else text
+
+def collect_garbage(referenced: Iterable[str], grace: float = GC_GRACE) -> int:
+    """
+    どのテストケースからも参照されていないファイルを消し、消した数を返す。
+    書き込み中の一時ファイル（.incoming-*）と、grace 秒以内に書いた・使い回したファイルは残す。
+    """
+    referenced = set(referenced)
+    cutoff = time.time() - grace
+    removed = 0
+    if not os.path.isdir(STORE_DIR):
+        return 0
+    for prefix in os.listdir(STORE_DIR):
+        directory = os.path.join(STORE_DIR, prefix)
+        if prefix.startswith(".") or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if name.startswith(".") or name in referenced:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue  # 同時に動いた別の collect_garbage が消した
+            removed += 1
+    return removed
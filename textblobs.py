@@ -0,0 +1,39 @@
+# textblobs.py
+"""
+提出コード・ヒント文の本体の形式。
+本体は内容の sha256 をキーにして text_blob テーブルに1回だけ置き（同じコードの再提出では行が増えない）、
+zlib で縮むものは縮めて保存する。DB の読み書きは呼び出し側（app.py, migrations.py）の役目で、
+ここではハッシュと圧縮・展開だけを扱う。
+"""
+import hashlib
+import os
+import zlib
+from typing import Tuple
+
+# zlib の圧縮レベル（1〜9）
+COMPRESS_LEVEL = int(os.environ.get("PDOJO_TEXT_COMPRESS_LEVEL", "6"))
+
+CODEC_RAW = "raw"
+CODEC_ZLIB = "zlib"
+
+def digest(body: str) -> str:
+    """本体の sha256（正規化はしない。caches.code_hash とは別物）。"""
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def pack(body: str) -> Tuple[str, int, str, bytes]:
+    """
+    保存する形にする。戻り値は (sha256, 元のバイト数, 形式, 保存するバイト列)。
+    短いヒント文のように縮まないものは、そのまま（raw）保存する。
+    """
+    raw = body.encode("utf-8")
+    compressed = zlib.compress(raw, COMPRESS_LEVEL)
+    if len(compressed) < len(raw):
+        return hashlib.sha256(raw).hexdigest(), len(raw), CODEC_ZLIB, compressed
+    return hashlib.sha256(raw).hexdigest(), len(raw), CODEC_RAW, raw
+
+def unpack(codec: str, data: bytes) -> str:
+    if codec == CODEC_ZLIB:
+        data = zlib.decompress(data)
+    elif codec != CODEC_RAW:
+        raise ValueError(f"unknown codec: {codec}")
+    return data.decode("utf-8")